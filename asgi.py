@@ -17,9 +17,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tipr.settings')
 
 django_asgi_app = get_asgi_application()
 from tipr.websocket_urls import websocket_urlpatterns
-application = ProtocolTypeRouter({
+from tipr.scheduler import ticker
+application = ticker.middleware(ProtocolTypeRouter({
     "http": django_asgi_app,
     'websocket': SessionMiddlewareStack(URLRouter(
             websocket_urlpatterns
         ))
-})
+}))
@@ -0,0 +1,151 @@
+# card balance: many simulated rps games over a process pool, aggregated per card.
+#
+#   python -m tipr.balance --games 10000 --processes 8 --format csv --out balance.csv
+#
+# per card: how often it was in the deck and played, how often playing it won the round,
+# how often it was played by the eventual winner, the damage dealt the rounds it was played,
+# and the mean length of games it was in.
+import argparse
+import collections
+import csv
+import json
+import logging
+import multiprocessing
+import sys
+import time
+
+from tipr.utils import *
+from tipr.sim import Simulation, random_policies
+
+policies = {
+    'random': random_policies['rps'],
+}
+
+FIELDS = ['card', 'slot', 'games', 'plays', 'round_wins', 'round_win_rate', 'game_win_rate',
+          'damage', 'damage_per_play', 'mean_rounds']
+
+
+# sim observer: remembers which card each seat played each round and the damage done with it
+class CardTracker(object):
+    def __init__(self):
+        self.plays = []  # [seat, slot, won round, damage]
+        self.round = None
+
+    def __call__(self, kind, sim, *args):
+        if kind != 'tick':
+            return
+        gamestate = sim.game.gamestate
+        meta = gamestate['meta']
+        if meta.get('stage') == 4 and self.round is None:
+            outcome = meta['outcome']
+            self.round = [[seat, gamestate[seat]['selection'].get('slot'),
+                           outcome['type'] not in ('truce', 'tie') and outcome['player'] == seat,
+                           gamestate[opp(seat)]['hp']] for seat in seats]
+        elif meta.get('stage') != 4 and self.round is not None:
+            self.close(gamestate)
+        if sim.game.status == FINISHED and self.round is not None:
+            self.close(gamestate)
+
+    def close(self, gamestate):
+        for seat, slot, won, hp in self.round:
+            if slot is not None:
+                self.plays.append([seat, slot, won, max(hp - gamestate[opp(seat)]['hp'], 0)])
+        self.round = None
+
+
+# one game. arguments and return value are plain so they pickle cheaply.
+def play(task):
+    seed, deck, policy_names, options = task
+    options = dict(options)
+    if deck:
+        options['deck'] = deck  # otherwise the sim deals one from the seed
+    tracker = CardTracker()
+    sim = Simulation('rps', [policies[name] for name in policy_names], options, seed, observer=tracker)
+    result = sim.run()
+    return {'seed': seed, 'deck': sim.game.options['deck'], 'winner': result.winner,
+            'rounds': result.rounds, 'error': result.error, 'plays': tracker.plays}
+
+def worker_init():
+    logging.disable(logging.WARNING)
+
+
+def tasks(games, seed, deck, policy_names, options):
+    for n in range(games):
+        yield seed + n, deck, policy_names, options
+
+def run(games, seed=0, deck=None, policy_names=('random', 'random'), options=None, processes=None, chunksize=16):
+    with multiprocessing.Pool(processes, initializer=worker_init) as pool:
+        return list(pool.imap_unordered(play, tasks(games, seed, deck, policy_names, options or {}), chunksize))
+
+
+def report(results):
+    cards = collections.defaultdict(lambda: Box(games=0, plays=0, round_wins=0, game_wins=0, damage=0, rounds=0))
+    for result in results:
+        if result['error']:
+            continue
+        deck = result['deck']
+        for slot, name in enumerate(deck):
+            cards[(slot, name)].games += 1
+            cards[(slot, name)].rounds += result['rounds']
+        for seat, slot, won, damage in result['plays']:
+            card = cards[(slot, deck[slot])]
+            card.plays += 1
+            card.round_wins += won
+            card.game_wins += seat == result['winner']
+            card.damage += damage
+
+    rows = []
+    for (slot, name), card in sorted(cards.items()):
+        plays = card.plays or 1
+        rows.append({'card': name, 'slot': slot, 'games': card.games, 'plays': card.plays,
+                     'round_wins': card.round_wins,
+                     'round_win_rate': round(card.round_wins / plays, 4),
+                     'game_win_rate': round(card.game_wins / plays, 4),
+                     'damage': card.damage,
+                     'damage_per_play': round(card.damage / plays, 2),
+                     'mean_rounds': round(card.rounds / (card.games or 1), 2)})
+    return rows
+
+def summary(results):
+    finished = [r for r in results if not r['error']]
+    return {'games': len(results), 'errors': len(results) - len(finished),
+            'p1': sum(r['winner'] == 'p1' for r in finished),
+            'p2': sum(r['winner'] == 'p2' for r in finished),
+            'tie': sum(r['winner'] is None for r in finished),
+            'mean_rounds': round(sum(r['rounds'] for r in finished) / (len(finished) or 1), 2)}
+
+def write(rows, out, format):
+    if format == 'csv':
+        writer = csv.DictWriter(out, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        json.dump(rows, out, indent=1)
+        out.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-card win rates from simulated rps games')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None, help='default: one per core')
+    parser.add_argument('--deck', help='comma separated card names, one per slot. default: RPSRules.deck() per game')
+    parser.add_argument('--policies', default='random,random', help=f'two of {sorted(policies)}')
+    parser.add_argument('--timed', action='store_true')
+    parser.add_argument('--format', default='json', choices=['json', 'csv'])
+    parser.add_argument('--out', help='default: stdout')
+    args = parser.parse_args()
+
+    deck = args.deck.split(',') if args.deck else None
+    start = time.perf_counter()
+    results = run(args.games, args.seed, deck, tuple(args.policies.split(',')), {'timed': args.timed}, args.processes)
+    elapsed = time.perf_counter() - start
+    if args.out:
+        with open(args.out, 'w', newline='') as out:
+            write(report(results), out, args.format)
+    else:
+        write(report(results), sys.stdout, args.format)
+    # games that raised are left out of the report. say which, so they can be replayed from their seed
+    for result in sorted((r for r in results if r['error']), key=lambda r: r['seed']):
+        print(f"seed {result['seed']}: {result['error']}", file=sys.stderr)
+    print(json.dumps(summary(results)), f'{len(results) / elapsed:.1f} games/s', file=sys.stderr)
@@ -0,0 +1,59 @@
+import logging
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+
+from tipr.scheduler import game_group
+from tipr.views import Update
+
+# no CHANNEL_LAYERS in settings means a single process, so an in-memory layer is enough
+if DEFAULT_CHANNEL_LAYER not in channel_layers:
+    channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer())
+
+
+# Pushes the rendered board, timer and chat to one socket whenever the game's version changes,
+# in the same format the update worker polls for ('U' = unchanged since the last push).
+class GameConsumer(AsyncJsonWebsocketConsumer):
+
+    async def connect(self):
+        self.game = self.scope['url_route']['kwargs']['id']
+        # the session may have to be loaded from the database, which can't happen in the event loop
+        self.name = await database_sync_to_async(self.scope['session'].get)('name')
+        self.sent = {}
+        self.version = None
+        self.chat_cursor = None
+        await self.channel_layer.group_add(game_group(self.game), self.channel_name)
+        await self.accept()
+        await self.push()
+
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard(game_group(self.game), self.channel_name)
+
+    # the client can ask for everything again, e.g. after its page was hidden
+    async def receive_json(self, content):
+        if content.get('load'):
+            self.sent = {}
+            self.version = None
+            self.chat_cursor = None
+        await self.push()
+
+    async def game_update(self, event):
+        await self.push()
+
+    async def push(self):
+        response = await database_sync_to_async(Update.do)(self.name, self.game, True, self.version, self.chat_cursor)
+        if 'error' in response:
+            await self.send_json(response)
+            return
+        if response.get('unchanged'):
+            return
+        self.version = response.pop('version')
+        self.chat_cursor = response.pop('chat_cursor')
+        # new chat lines are always new; everything else is sent only if it differs
+        changed = {key: value for key, value in response.items()
+                   if (value if key == 'chat_lines' else self.sent.get(key) != value)}
+        if not changed:
+            return
+        self.sent.update(changed)
+        await self.send_json({key: changed.get(key, 'U') for key in response})
@@ -0,0 +1,295 @@
+# applying deltas to gamestates. this is utils.update: every tick, move and history replay goes
+# through it, so it works on plain dicts and lists (a Box is a dict, and still works, just slower),
+# dispatches on exact types before falling back to isinstance, and never logs unless something fails.
+#
+#   python -m tipr.delta --games 20
+#
+# checks apply() against reference_apply() (update() as it was) on the deltas and histories of
+# simulated games, and times replaying their histories with each.
+import argparse
+import copy
+import json
+import logging
+import pickle
+import time
+from collections.abc import Mapping
+
+
+# apply all ops to the base modifier, then apply the final modifier
+# e.g. starting hp 15, -2 base dmg, -1, x2 = -6 -> 9hp
+mod_table = {
+    'add': lambda x, y: x + y,
+    'mul': lambda x, y: x * y,
+}
+def combine_numeric_modifiers(mods):
+    final_mod = 0
+    for mod in mods:
+        final_mod = mod_table[mod[0]](final_mod, mod[1])
+    return final_mod
+
+# handling numbers:
+# update = False, ie, we're working on a delta
+# existing, new:
+#   nothing, number or tuple -> new value
+#   number, number -> new number
+#   number, tuple -> error. the idea is that numbers are for meta stuff and tuples are for gamestate vals
+#   tuple, number -> error
+#   (str, num), tuple -> (old tuple, new tuple)
+#   (tup, tup), tuple -> (tup, tup, new tuple)
+# update = True
+#   nothing, number -> number
+#   nothing, tuple -> tupleops(0). maybe. the idea is that this could handle "counters" in the future
+#   number, number -> new number
+#   number, tuple -> tupleops(number)
+#
+# values:
+#   'del' -> delete the key
+#   None -> None
+#   {'dins': x} -> append x to 'ins', for building list deltas
+#   tuple -> modifiers, see above
+#   on a list: a list replaces it, otherwise a dict of list ops, applied in this order:
+#     deletes, del_values [values], ins [values], set [idx, value], rep list, upd {idx: delta}
+#   {'replace': x} -> x
+#   any other dict -> merged into what's there, recursively
+#   anything else -> assigned
+def apply(d, u):
+    if not u:
+        return d
+    for k, v in u.items():
+        t = type(v)
+        if t is str or isinstance(v, str):
+            if v == 'del':
+                del d[k]
+                continue
+        elif v is None:
+            d[k] = None
+            continue
+        if k == 'dins':  # 'delta insert'
+            if 'ins' in d:
+                d['ins'].append(v)
+            else:
+                d['ins'] = [v]
+            continue
+        if t is tuple:
+            if k not in d:
+                d[k] = v
+            else:
+                old = d[k]
+                if type(old) is tuple:
+                    d[k] = old + v
+                elif type(old) is int:
+                    d[k] = old + combine_numeric_modifiers(v)
+                else:
+                    raise RuntimeError(f"Don't put tuples ({v}) on {old}")
+            continue
+        if k in d:
+            old = d[k]
+            if type(old) is tuple:
+                raise RuntimeError(f"Don't put {v} on tuples ({old})")
+            if type(old) is list or isinstance(old, list):
+                if t is list or isinstance(v, list):
+                    d[k] = v
+                else:
+                    apply_list(d, k, v)
+                continue
+        if t is dict or isinstance(v, Mapping):
+            if 'replace' in v:
+                d[k] = v['replace']
+            else:
+                d[k] = apply(d.get(k, {}), v)
+            continue
+        try:
+            d[k] = v
+        except Exception as e:
+            logging.warning(f"Update error: {e}, {d}, {k}, {v}")
+    return d
+
+def apply_list(d, k, v):
+    if 'deletes' in v:
+        d[k] = filter(lambda i, x: i not in v['deletes'], enumerate(d[k]))
+    if 'del_values' in v:
+        for del_val in v['del_values']:
+            d[k].remove(del_val)
+    if 'ins' in v:
+        d[k].extend(v['ins'])
+    if 'set' in v:
+        d[k][v['set'][0]] = v['set'][1]
+    if 'rep' in v:
+        d[k] = v['rep']
+    if 'upd' in v:
+        items = d[k]
+        for idx, delta in v['upd'].items():
+            items[idx] = apply(items[idx], delta)
+
+# an event as it comes back from the database or the sim: JSON has turned its modifier tuples
+# into lists, (('add', -5),) -> [['add', -5]], which apply() would put in place of the number
+def stored_delta(value):
+    t = type(value)
+    if t is dict:
+        return {k: stored_delta(v) for k, v in value.items()}
+    if t is list:
+        if value and all(type(mod) is list and len(mod) == 2 and mod[0] in mod_table for mod in value):
+            return tuple(tuple(mod) for mod in value)
+        return [stored_delta(v) for v in value]
+    return value
+
+# deepcopy for gamestates: a pickle round trip is several times faster than copy.deepcopy on
+# trees of dicts, lists and plain values
+def copy_state(value):
+    return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+# update() before apply(), kept to check apply() against
+def reference_apply(d, u):
+    logging.warning(f'{d}\n{u}')
+    if not u:
+        return d
+    for k, v in u.items():
+        if v == 'del':
+            del d[k]
+        elif v is None:
+            d[k] = None
+        elif k == 'dins':  # 'delta insert'
+            if 'ins' in d:
+                d['ins'].append(v)
+            else:
+                d['ins'] = [v]
+        elif type(v) is tuple:
+            if k not in d:
+                d[k] = v
+            else:
+                if type(d[k]) is tuple:
+                    d[k] = tuple(list(d[k]) + list(v))
+                elif type(d[k]) is int:
+                    base = d[k] if k in d else 0
+                    d[k] = base + combine_numeric_modifiers(v)
+                else:
+                    raise RuntimeError(f"Don't put tuples ({v}) on {d[k]}")
+        elif k in d and type(d[k]) is tuple:
+            raise RuntimeError(f"Don't put {v} on tuples ({d[k]})")
+        elif k in d and isinstance(d[k], list):
+            if isinstance(v, list):
+                d[k] = v
+                continue
+            if 'deletes' in v:
+                d[k] = filter(lambda i, x: i not in v['deletes'], enumerate(d[k]))
+            if 'del_values' in v:
+                for del_val in v['del_values']:
+                    d[k].remove(del_val)
+            if 'ins' in v:
+                d[k].extend(v['ins'])
+            if 'set' in v:
+                d[k][v['set'][0]] = v['set'][1]
+            if 'rep' in v:
+                d[k] = v['rep']
+            if 'upd' in v:
+                logging.warn(f'{d} v: {v}')
+                for idx, delta in v['upd'].items():
+                    d[k][idx] = reference_apply(d[k][idx], delta)
+        elif isinstance(v, Mapping):
+            if 'replace' in v:
+                d[k] = v['replace']
+            else:
+                d[k] = reference_apply(d.get(k, {}), v)
+        else:
+            try:
+                d[k] = v
+            except Exception as e:
+                logging.warning(f"Update error: {e}, {d}, {k}, {v}")
+    return d
+
+
+# the outcome of fn(state, delta) on copies: the resulting state, or the exception it raised
+def outcome(fn, state, delta):
+    try:
+        return repr(fn(copy.deepcopy(state), copy.deepcopy(delta)))
+    except Exception as e:
+        return f'raised {e!r}'
+
+# stands in for a sim's rules, collecting (state before, delta) for every move and tick
+class DeltaRecorder(object):
+    def __init__(self, rules):
+        self.rules = rules
+        self.pairs = []
+
+    def __getattr__(self, name):
+        return getattr(self.rules, name)
+
+    def record(self, game, delta):
+        self.pairs.append((copy.deepcopy(game.gamestate), copy.deepcopy(delta)))
+        return delta
+
+    def move(self, game, seat, move):
+        return self.record(game, self.rules.move(game, seat, move))
+
+    def do_update(self, game):
+        return self.record(game, self.rules.do_update(game))
+
+def record(type, seed, options):
+    from tipr.sim import Simulation
+    sim = Simulation(type, options=options, seed=seed)
+    sim.rules = recorder = DeltaRecorder(sim.rules)
+    sim.run()
+    return recorder.pairs, sim.game.history
+
+# [description, ..] of everywhere apply and reference_apply disagree
+def differences(pairs, histories):
+    found = []
+    for state, delta in pairs:
+        if (new := outcome(apply, state, delta)) != (old := outcome(reference_apply, state, delta)):
+            found.append(f'{delta}: {new} != {old}')
+    for history in histories:
+        for interval_idx, interval in enumerate(history):
+            frame = copy.deepcopy(interval[0])
+            for i in range(1, len(interval)):
+                if (new := outcome(apply, frame, interval[i])) != (old := outcome(reference_apply, frame, interval[i])):
+                    found.append(f'interval {interval_idx} event {i}: {new} != {old}')
+                if old.startswith('raised'):
+                    break
+                frame = reference_apply(frame, copy.deepcopy(interval[i]))
+    return found
+
+# seconds to rebuild every history the way intermediate_states does: every state of each
+# interval, or just the last one (History.frame, Book)
+def time_replay(fn, histories, copier, last_only=False):
+    start = time.perf_counter()
+    for history in histories:
+        for interval in history:
+            frame = copier(interval[0])
+            states = [] if last_only else [copier(frame)]
+            for event in interval[1:]:
+                try:
+                    frame = fn(frame, event)
+                except Exception:
+                    break  # the differences check reports these
+                if not last_only:
+                    states.append(copier(frame))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check apply() against the old update() and time history replays')
+    parser.add_argument('--type', default='rps')
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timed', action='store_true')
+    parser.add_argument('--fast', action='store_true', help='rps fast_resolve')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    pairs, histories = [], []
+    for n in range(args.games):
+        game_pairs, history = record(args.type, args.seed + n, {'timed': args.timed, 'fast_resolve': args.fast})
+        pairs.extend(game_pairs)
+        histories.append(json.loads(json.dumps(history)))
+    found = differences(pairs, histories)
+    for difference in found[:10]:
+        print(difference)
+    events = sum(len(interval) for history in histories for interval in history)
+    print(f'{len(found)} differences in {len(pairs)} deltas and {events} history events')
+
+    for last_only in (False, True):
+        old = time_replay(reference_apply, histories, copy.deepcopy, last_only)
+        new = time_replay(apply, histories, copy_state, last_only)
+        print(f'replay {"last states" if last_only else "all states"}: {old:.3f}s -> {new:.3f}s ({old / new:.1f}x)')
+    raise SystemExit(1 if found else 0)
@@ -0,0 +1,143 @@
+# ACTIVE games kept in memory between requests, parsed, with their history, so polls, moves and
+# ticks don't load and parse the row each time. one process only: another process writing the
+# same games would never be seen. enable with TIPR_HOT_STORE = True in settings.
+#
+# hot games write behind (Game.hold): plain ticks stay in memory for up to
+# TIPR_HOT_STORE_WRITE_BEHIND seconds, everything else is written as it happens. a crash loses
+# at most those ticks, and the rules redo them from the last written state. their versions are
+# lost too and get used again, so the versions clients see carry a per-process epoch.
+#
+#   with hot_store.checkout(id) as game, transaction.atomic():
+#       ...
+#
+# a checked out game is locked until the block ends, so everything that changes a game goes
+# through checkout, outside the transaction so the lock lasts until the commit. on an exception
+# the game is dropped and reloaded from the database next time, which is also how a game written
+# by another process (Game.Conflict) gets picked up again.
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+from tipr import tracing
+from tipr.utils import *
+
+
+RELEASE_TIMEOUT = 10
+FLUSH_EVERY = 1  # seconds between flush_stale calls from the scheduler
+
+
+class HotStore(object):
+
+    def __init__(self):
+        self.games = {}  # id -> Game
+        self.locks = {}  # id -> RLock
+        self.lock = threading.Lock()
+        # this process. versions clients are sent carry it, see views.UpdateView.tag
+        self.epoch = format(time.time_ns(), 'x')
+
+    def enabled(self):
+        return getattr(settings, 'TIPR_HOT_STORE', False)
+
+    def lock_for(self, id):
+        with self.lock:
+            return self.locks.setdefault(id, threading.RLock())
+
+    @contextmanager
+    def checkout(self, id):
+        from tipr.models import Game
+        id = int(id) if id else None
+        if not self.enabled():
+            with tracing.span('load'):
+                game = Game.objects.filter(pk=id).first() if id else None
+            yield game
+            return
+        with self.lock_for(id):
+            game = self.games.get(id)
+            if game is None and id:
+                with tracing.span('load'):
+                    game = Game.objects.filter(pk=id).first()
+                if game and game.status == ACTIVE:
+                    game.write_behind = getattr(settings, 'TIPR_HOT_STORE_WRITE_BEHIND', 5)
+                    self.games[id] = game
+            try:
+                yield game
+            except BaseException:
+                self.drop(id)
+                raise
+            if game and game.status != ACTIVE:
+                self.games.pop(id, None)
+
+    # the hot copy of a game, if there is one, for reads that don't need the lock
+    def peek(self, id):
+        return self.games.get(id)
+
+    # stop keeping a game whose held state may never reach the database, along with the history
+    # frames that might have been built from it
+    def drop(self, id):
+        from tipr.models import forget_frames
+        self.games.pop(id, None)
+        forget_frames(id)
+
+    # write out what games are holding and stop keeping them, before changing their rows directly.
+    # the caller may be holding another game's lock, so this gives up rather than wait forever.
+    def release(self, ids):
+        from tipr.models import Game
+        for id in ids:
+            if id not in self.games:
+                continue
+            lock = self.lock_for(id)
+            if not lock.acquire(timeout=RELEASE_TIMEOUT):
+                raise RuntimeError(f'game {id} is busy')
+            try:
+                with transaction.atomic():
+                    if game := self.games.pop(id, None):
+                        game.persist()
+            except Game.Conflict:
+                self.drop(id)  # written elsewhere since: what was held is lost, and the rules redo it
+            finally:
+                lock.release()
+
+    # stop keeping games whose rows the caller changed directly, once that commits: until then
+    # anyone can load and keep the old row again. the lock waits out a checkout that's doing so.
+    def evict(self, ids):
+        def evict():
+            for id in ids:
+                lock = self.lock_for(id)
+                locked = lock.acquire(timeout=RELEASE_TIMEOUT)
+                try:
+                    self.drop(id)
+                finally:
+                    if locked:
+                        lock.release()
+        if self.enabled():
+            transaction.on_commit(evict)
+
+    # write out everything held longer than its write_behind, for games nothing else is touching
+    def flush_stale(self):
+        from tipr.models import Game
+        now = time.monotonic()
+        for id, game in list(self.games.items()):
+            if game._held_since is not None and now - game._held_since > game.write_behind:
+                with self.lock_for(id):
+                    try:
+                        with transaction.atomic():
+                            game.persist()
+                    except Game.Conflict:
+                        self.drop(id)
+
+    def flush_all(self):
+        for id, game in list(self.games.items()):
+            try:
+                with self.lock_for(id), transaction.atomic():
+                    game.persist()
+            except Exception:
+                logging.exception(f'writing held state for game {id} failed')
+
+
+hot_store = HotStore()
+atexit.register(hot_store.flush_all)
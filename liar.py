@@ -1,10 +1,10 @@
 import functools, copy, json
-import logging
-from termcolor import colored as c
-from random import choice, shuffle
+import random
+from tipr import tracing
 from tipr.utils import *
 from tipr.rps_cards import *
 from tipr.rules import Rules
+from tipr.tracked import track
 
 ROUND_STRUCTURE = ['START'] + ['WRITE', 'CLARIFY', 'BET'] * 3 + ['REVEAL', 'BET', 'ADJUDICATE', 'DONE']
 
@@ -58,7 +58,7 @@ class LiarRules(Rules):
         if game.next_tick == -1:
             return game.status == ACTIVE and both
         if timed := (game.status == ACTIVE and game.has_ticked(timestamp)):
-            logging.warn(c('TIMED', 'red'))
+            tracing.event('timed out')
         return game.status == ACTIVE and (timed or both)
 
     def winner(self, gamestate):
@@ -72,10 +72,10 @@ class LiarRules(Rules):
                 return f'{s1} - {s2}: p2 wins!'
          
     def do_update(self, game):
-        return self.pure_update(Box(game.options), Box(game.gamestate), game.history)
+        return self.pure_update(Box(game.options), game.gamestate, game.history, self.rng(game))
 
-    def pure_update(self, options, gamestate, history):
-        prev_state = copy.deepcopy(gamestate)
+    def pure_update(self, options, gamestate, history, rng=random):
+        gamestate = track(gamestate)
         last_round_type = ROUND_STRUCTURE[gamestate.meta.round]
         if last_round_type != 'DONE':
             gamestate.meta.round += 1
@@ -84,10 +84,10 @@ class LiarRules(Rules):
         match last_round_type:
             case 'START':
                 DECK = list(range(1,10)) * 5
-                shuffle(DECK)
+                rng.shuffle(DECK)
                 gamestate.p1.hand = DECK[0:5]
                 gamestate.p2.hand = DECK[5:10]
-                logging.warning(f"{gamestate.p1.hand} {gamestate.p2.hand} XXXXX")
+                tracing.event('deal', p1=lambda: gamestate.p1.hand, p2=lambda: gamestate.p2.hand)
 
             case 'WRITE':
                 p1_statement = gamestate.p1.submission or 'One equals one'
@@ -122,13 +122,13 @@ class LiarRules(Rules):
                             if submission and (sid := submission.get(str(statement_id))):
                                 amt = sid.get(truth, 0)
                             gamestate.statements[statement_id]['votes'][f'{seat}_{truth}'].append(amt)
-                    logging.warning(f'BETS {seat}: {gamestate.statements}')
+                    tracing.event('bets', seat=seat, statements=lambda: gamestate.statements)
                             
             case 'REVEAL':
                 for seat in seats:
                     sub = gamestate.ga(seat).submission
                     if sub is None:
-                        sub = int(choice(gamestate.ga(seat).hand))
+                        sub = int(rng.choice(gamestate.ga(seat).hand))
                     else:
                         sub = int(sub)
                     if sub not in gamestate.ga(seat).hand:
@@ -171,15 +171,14 @@ class LiarRules(Rules):
         gamestate.p2.submission = None
         gamestate.p1.to_revise = gamestate.p2.to_revise = None
 
-        patch = gen_patch(prev_state, gamestate)
-        logging.warn(c(f'^ UPDATE {patch}', 'red'))
+        patch = gamestate.delta()
         return patch
 
 
     def move(self, game, seat, move):
         if not game.status == ACTIVE:
             return {'error': f'game is {game.status}'}
-        gamestate = Box(game.gamestate)
+        gamestate = track(game.gamestate)
         seat = f"p{seat+1}"
         
         def invalid_statement(move):
@@ -197,7 +196,6 @@ class LiarRules(Rules):
                 gamestate.ga(seat).submission = move
                 
             case 'CLARIFY' | 'ADJUDICATE':
-                logging.warn(move)
                 gamestate.ga(seat).submission = move
                 
             case 'BET':
@@ -217,20 +215,19 @@ class LiarRules(Rules):
                     return {'error': f"expecting a card value to reveal, got {repr(move)}"}
                 gamestate.ga(seat).submission = move
 
-        return gen_patch(Box(game.gamestate), gamestate)
+        return gamestate.delta()
 
     def next_tick(self, game):
         round = ROUND_STRUCTURE[game.gamestate['meta']['round']] 
-        logging.warning(f"{round}: {game.options['timer']}")
         if round == 'START':
             return 0
         if round in ('CLARIFY', 'ADJUDICATE'):
             return -1
         return game.options['timer']
 
-    def gameboard_context(self, name, seat, game, gamestate, now):
+    def gameboard_context(self, name, seat, game, gamestate, now, chat=None):
         response = Box()
-        gameboard_context = game.response(self.response(game, seat), now)
+        gameboard_context = game.response(self.response(game, seat), now, chat=chat)
         gameboard_context.name = name
         gameboard_context.p1_name = game.people[0][0] if len(game.people[0]) else 'p1'
         gameboard_context.p2_name = game.people[0][1] if len(game.people[0]) > 1 else 'p2'
@@ -246,7 +243,7 @@ class LiarRules(Rules):
         gameboard_context.bet = round == 'BET'
         gameboard_context.showdown = round in ['DONE', 'ADJUDICATE']
         gameboard_context.done = round in ['DONE']
-        logging.warning(f'FFF {gamestate.statements}')
+        tracing.event('board', round=round, statements=lambda: gamestate.statements)
         gameboard_context.columns = [{'player': gameboard_context.p1_name, 'statements': [(gamestate.statements[i].copy(), i) for i in range(0, len(gamestate.statements), 2)]},
                                      {'player': gameboard_context.p2_name, 'statements': [(gamestate.statements[i].copy(), i) for i in range(1, len(gamestate.statements), 2)]}]
         
@@ -254,7 +251,6 @@ class LiarRules(Rules):
         gameboard_context.increased_cap = 1 if gamestate.meta.round == 11 else 0
         for data in gameboard_context.columns:
             for statement, i in data['statements']:
-                logging.warning(statement)
                 for votekey, votelist in list(statement.votes.items()):
                     vlist = votelist.copy()
                     statement['votes'][votekey + "_past"] = '<br>'.join(["⬤"*x + "◯" * ((i//2+1+(1 if x == 3 else 0)) - x) for x in map(int,vlist)])
@@ -263,7 +259,6 @@ class LiarRules(Rules):
             for col in gameboard_context.columns:
                 col['extra_column'] = round
         if gamestate.meta.round > ROUND_STRUCTURE.index('REVEAL'):
-            logging.warn(f'revealed: {gamestate.revealed}')
             gameboard_context.columns[0]['revealed'] = gamestate.revealed[0]
             gameboard_context.columns[1]['revealed'] = gamestate.revealed[1]
 
@@ -0,0 +1,232 @@
+# a load generator: simulated rps and liar players, spectators and lobby watchers driving the real
+# views (Register, Sit, Submit, the update path, the lobby) in one process, through Django's ASGI
+# handler with no server (pollbench.Client), against the configured database, SQLite or Postgres,
+# and an in-memory cache.
+#
+#   DJANGO_SETTINGS_MODULE=tipr.settings python -m tipr.loadtest --rps 20 --liar 5 --spectators 100 --lobby 20
+#
+# each table is two players who register, sit down and play one game after another, making the
+# random legal moves sim.py's policies make, decided on the game as it is on the server. everyone
+# polls at their own rate. at the end there's one line per endpoint: requests, requests/s, latency
+# percentiles, errors and database queries per request, counted on the server from the traces
+# (register isn't traced, so it has none).
+#
+# on SQLite, concurrent writes fail with "database is locked" unless transactions start as writers:
+# 'OPTIONS': {'transaction_mode': 'IMMEDIATE'} in DATABASES (Django 5.1+). they are still one at a
+# time, so numbers that mean anything for a deployment come from Postgres.
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+from tipr.pollbench import Client, latencies
+
+
+class Stats(object):
+    def __init__(self):
+        self.seconds = {}  # endpoint -> [seconds, ..]
+        self.errors = {}  # endpoint -> count
+        self.queries = {}  # trace name -> [queries, ..]
+        self.moves = 0
+        self.rejected = 0  # moves the rules turned down, e.g. made on a state that had moved on
+        self.games = 0
+
+    # a finished trace, see tracing.listeners
+    def trace(self, record):
+        self.queries.setdefault(record['name'], []).append(record['counts'].get('db_queries', 0))
+
+    async def timed(self, endpoint, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+        except Exception:
+            logging.exception(f'{endpoint} failed')
+            response = None
+        self.seconds.setdefault(endpoint, []).append(time.perf_counter() - start)
+        if response is None or response.status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None
+        return response
+
+    def report(self, elapsed):
+        lines = []
+        for endpoint in sorted(set(self.seconds) | set(self.queries)):
+            seconds = self.seconds.get(endpoint, [])
+            queries = self.queries.get(endpoint)
+            lines.append({'endpoint': endpoint, 'requests': len(seconds), 'requests/s': round(len(seconds) / elapsed, 1),
+                          'errors': self.errors.get(endpoint, 0), **latencies(seconds),
+                          'traced': len(queries) if queries else 0,  # ticks are only seen here
+                          'queries/request': round(sum(queries) / len(queries), 2) if queries else None,
+                          'queries': sum(queries) if queries else None})
+        return lines
+
+
+# polls the update path like the update worker, keeping the version and chat cursor it was sent.
+# poll() says whether the game has moved on.
+class Poller(object):
+    def __init__(self, client, stats, prefix, game):
+        self.client = client
+        self.stats = stats
+        self.game = game
+        self.path = f'{prefix}/update/{game}/'
+        self.version = None
+        self.chat_cursor = None
+
+    async def poll(self):
+        query = {}
+        if self.version is not None:
+            query['version'] = self.version
+        if self.chat_cursor is not None:
+            query['chat_cursor'] = self.chat_cursor
+        response = await self.stats.timed('update', self.client.get(self.path, query))
+        if response is None or response.status != 200:
+            return False
+        body = response.json()
+        if 'version' not in body:
+            return False
+        self.version = body['version']
+        self.chat_cursor = body.get('chat_cursor', self.chat_cursor)
+        return True
+
+
+async def register(client, stats, name):
+    await stats.timed('register', client.post('/register/', {'name': name}))
+
+# the game as its players know it from their page. the hot copy, if there is one, is the newest
+async def current(id):
+    from tipr.hotstore import hot_store
+    from tipr.models import Game
+    return hot_store.peek(id) or await Game.objects.filter(pk=id).afirst()
+
+# two players at one table, playing games of type until stop
+async def table(app, stats, prefix, type, number, fps, stop, tables, rng):
+    from tipr.sim import random_policies
+    from tipr.utils import FINISHED
+    policy = random_policies[type]
+    for round in itertools.count():
+        if time.perf_counter() >= stop:
+            return
+        players = [Client(app), Client(app)]
+        for seat, player in enumerate(players):
+            await register(player, stats, f'{type}{number}-{round}-{seat}')
+        response = await stats.timed('sit', players[0].post(f'{prefix}/sit/', {'seat': 0, 'type': type}))
+        if response is None or 'game' not in response.json():
+            return
+        game = response.json()['game']
+        if await stats.timed('sit', players[1].post(f'{prefix}/sit/', {'seat': 1, 'game': game})) is None:
+            return
+        tables.add(game)
+        pollers = [Poller(player, stats, prefix, game) for player in players]
+        await asyncio.sleep(rng.uniform(0, 1 / fps))
+        next_poll = time.perf_counter()
+        finished = False
+        retry = [False, False]  # the last move was turned down, so try another without waiting for a change
+        while not finished and next_poll < stop:
+            await asyncio.sleep(max(next_poll - time.perf_counter(), 0))
+            next_poll += 1 / fps
+            for seat, poller in enumerate(pollers):
+                if not await poller.poll() and not retry[seat]:
+                    continue
+                state = await current(game)
+                if state is None or state.status == FINISHED:
+                    finished = True
+                    break
+                if (move := policy(state, seat, rng)) is None:
+                    continue
+                response = await stats.timed('submit', players[seat].post(
+                    f'{prefix}/submit/', {'game': game, 'move': json.dumps(move)}))
+                stats.moves += 1
+                retry[seat] = response is not None and 'error' in response.json()
+                stats.rejected += retry[seat]
+        tables.discard(game)
+        if finished:
+            stats.games += 1
+
+# watches a game being played, moving to another when it ends and now and then
+async def spectator(app, stats, prefix, number, fps, stop, tables, rng):
+    client = Client(app)
+    await register(client, stats, f'watcher{number}')
+    poller = None
+    next_poll = time.perf_counter() + rng.uniform(0, 1 / fps)
+    while next_poll < stop:
+        await asyncio.sleep(max(next_poll - time.perf_counter(), 0))
+        next_poll += 1 / fps
+        if not tables:
+            continue
+        if poller is None or poller.game not in tables or rng.random() < .001:
+            poller = Poller(client, stats, prefix, rng.choice(sorted(tables)))
+        await poller.poll()
+
+# keeps a lobby page up to date from the change feed
+async def lobby_watcher(app, stats, prefix, rate, stop, rng):
+    client = Client(app)
+    version = None
+    next_poll = time.perf_counter() + rng.uniform(0, 1 / rate)
+    while next_poll < stop:
+        await asyncio.sleep(max(next_poll - time.perf_counter(), 0))
+        next_poll += 1 / rate
+        response = await stats.timed('lobby', client.get(f'{prefix}/lobby/', {'since': version} if version else {}))
+        if response is not None:
+            version = response.json().get('version', version)
+
+async def run(args):
+    from django.core.asgi import get_asgi_application
+    from tipr import tracing
+    from tipr.scheduler import ticker
+    app = ticker.middleware(get_asgi_application())
+    stats = Stats()
+    tracing.listeners.append(stats.trace)
+    rng = random.Random(args.seed)
+    prefix = {'sync': '/sync', 'async': '/async', 'default': ''}[args.views]
+    tables = set()  # games being played, for spectators
+    start = time.perf_counter()
+    stop = start + args.seconds
+    players = [table(app, stats, prefix, type, n, args.player_fps, stop, tables, random.Random(rng.random()))
+               for type, count in (('rps', args.rps), ('liar', args.liar)) for n in range(count)]
+    watchers = [spectator(app, stats, prefix, n, args.spectator_fps, stop, tables, random.Random(rng.random()))
+                for n in range(args.spectators)]
+    lobbies = [lobby_watcher(app, stats, prefix, args.lobby_rate, stop, random.Random(rng.random()))
+               for n in range(args.lobby)]
+    await asyncio.gather(*players, *watchers, *lobbies)
+    elapsed = time.perf_counter() - start
+    tracing.listeners.remove(stats.trace)
+    return stats, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='simulated players, spectators and lobby watchers against the real views')
+    parser.add_argument('--rps', type=int, default=10, help='rps tables, two players each')
+    parser.add_argument('--liar', type=int, default=2, help='liar tables, two players each')
+    parser.add_argument('--spectators', type=int, default=50)
+    parser.add_argument('--lobby', type=int, default=10, help='lobby watchers')
+    parser.add_argument('--player-fps', type=float, default=8)
+    parser.add_argument('--spectator-fps', type=float, default=8)
+    parser.add_argument('--lobby-rate', type=float, default=1, help='lobby polls a second')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--views', default='default', choices=['default', 'sync', 'async'],
+                        help='default: whatever TIPR_ASYNC_VIEWS says')
+    parser.add_argument('--scheduler', action='store_true', help='ticks from the tick scheduler instead of polls')
+    parser.add_argument('--hot', action='store_true', help='with TIPR_HOT_STORE on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from django.conf import settings
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    # the queries per request come from the traces
+    settings.TIPR_METRICS = True
+    settings.TIPR_TICK_SCHEDULER = args.scheduler
+    settings.TIPR_HOT_STORE = args.hot
+    import django
+    django.setup()
+    # the rules log at warning level
+    logging.disable(logging.WARNING)
+
+    stats, elapsed = asyncio.run(run(args))
+    for line in stats.report(elapsed):
+        print(json.dumps(line))
+    requests = sum(len(seconds) for seconds in stats.seconds.values())
+    print(f'{requests / elapsed:.1f} requests/s over {elapsed:.1f}s, {stats.moves} moves '
+          f'({stats.rejected} rejected), {stats.games} games finished')
@@ -0,0 +1,132 @@
+# the lobby as JSON: pages of unfinished games, and a feed of changes so a client that has a page
+# can patch it instead of fetching it again.
+#
+#   GET /lobby/?type=rps&open=1&mine=1&page=2&per_page=50   -> {version, games: [row, ..], page, pages, count}
+#   GET /lobby/?since=<version>   -> {version, changes: [{kind, id, row}, ..]}
+#
+# every change to what the lobby shows (a game created, a seat taken, a status change) bumps a
+# version counter in the Django cache and stores the change under lobby_change_<version>, so
+# pages are cached per version and the feed is a get_many. if the feed has a gap (expired, or too
+# far behind) the answer is a fresh page, with reset: true. a page can already include changes
+# newer than its version, so clients apply changes as upserts by id.
+#
+# aversion, achanges_since and apage are the same for async views (views.AsyncLobbyView).
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+from tipr.render_cache import render_cache
+from tipr.utils import *
+
+VERSION_KEY = 'lobby_version'
+PER_PAGE = 50
+MAX_PER_PAGE = 200
+FEED_MAX = 200  # changes a client can be behind before it has to reload
+CHANGE_TTL = 600
+
+
+def change_key(version):
+    return f'lobby_change_{version}'
+
+def version():
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        # starting from the clock, so a lost counter doesn't come back with versions clients have seen.
+        # it never expires, but a cache can still evict it
+        cache.add(VERSION_KEY, int(time.time() * 1000), timeout=None)
+        current = cache.get(VERSION_KEY)
+    return current
+
+async def aversion():
+    current = await cache.aget(VERSION_KEY)
+    if current is None:
+        await cache.aadd(VERSION_KEY, int(time.time() * 1000), timeout=None)
+        current = await cache.aget(VERSION_KEY)
+    return current
+
+# what a client needs to show a game: the same for page rows and changes
+def row(pk, type, status, people):
+    players = people[0] if people else []
+    return {'id': pk, 'type': type, 'status': status, 'players': players,
+            'open': [seat for seat, name in enumerate(players) if not name]}
+
+def game_row(game):
+    return row(game.pk, game.type, game.status, game.people)
+
+# kind: 'added', 'changed' (seats or status) or 'removed' (finished). sent once the transaction
+# commits, so a rolled back change never reaches the feed.
+def publish(kind, game_row):
+    change = {'kind': kind, 'id': game_row['id'], 'row': None if kind == 'removed' else game_row}
+    def send():
+        try:
+            new_version = cache.incr(VERSION_KEY)
+        except ValueError:  # gone since it was last read
+            version()
+            new_version = cache.incr(VERSION_KEY)
+        cache.set(change_key(new_version), change, CHANGE_TTL)
+    transaction.on_commit(send)
+
+# (version, [change, ..]) since a version, or (version, None) if they aren't all there
+def changes_since(since):
+    current = version()
+    keys = feed_keys(since, current)
+    if not keys:
+        return current, keys
+    return current, feed(keys, cache.get_many(keys))
+
+async def achanges_since(since):
+    current = await aversion()
+    keys = feed_keys(since, current)
+    if not keys:
+        return current, keys
+    return current, feed(keys, await cache.aget_many(keys))
+
+# the keys of the changes since a version, or None if the client is too far behind
+def feed_keys(since, current):
+    if since > current or current - since > FEED_MAX:
+        return None
+    return [change_key(v) for v in range(since + 1, current + 1)]
+
+def feed(keys, found):
+    if len(found) != len(keys):
+        return None
+    return [found[key] for key in keys]
+
+def listed(name, type, open, mine):
+    from tipr.models import Game
+    games = Game.open_seats() if open else Game.objects.filter(status__lt=FINISHED)
+    if type:
+        games = games.filter(type=type)
+    if mine:
+        games = games.filter(pk__in=Game.games_of(name).values('pk')) if name else games.none()
+    return games.order_by('pk')
+
+def page_key(current, name, type, open, mine, number, per_page):
+    return ('lobby_page', current, name if mine else None, type, open, number, per_page)
+
+def page_rows(games, number, per_page):
+    start = (number - 1) * per_page
+    return games.values_list('pk', 'type', 'status', 'people')[start:start + per_page]
+
+def listing(current, rows, count, number, per_page):
+    return {'version': current, 'games': [row(*values) for values in rows], 'page': number,
+            'pages': max((count + per_page - 1) // per_page, 1), 'count': count}
+
+def page(name=None, type=None, open=False, mine=False, number=1, per_page=PER_PAGE):
+    current = version()
+    def query():
+        games = listed(name, type, open, mine)
+        return listing(current, page_rows(games, number, per_page), games.count(), number, per_page)
+    return render_cache.get_or_render(page_key(current, name, type, open, mine, number, per_page), query)
+
+async def apage(name=None, type=None, open=False, mine=False, number=1, per_page=PER_PAGE):
+    current = await aversion()
+    key = page_key(current, name, type, open, mine, number, per_page)
+    response = render_cache.get(key)
+    if response is None:
+        games = listed(name, type, open, mine)
+        rows = [values async for values in page_rows(games, number, per_page)]
+        response = listing(current, rows, await games.acount(), number, per_page)
+        render_cache.set(key, response)
+    return response
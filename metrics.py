@@ -0,0 +1,152 @@
+# in-process metrics, scraped as Prometheus text from /metrics/.
+#
+# request and phase latencies come from the traces (tracing.py): every finished trace is one
+# request to its endpoint (update, submit, sit, lobby, tick), and its spans are the phases
+# (load, rules, render, save). database queries are counted onto the running trace by a
+# wrapper on every connection. ticks, rewinds and render cache hits are plain counters.
+#
+# on by default; TIPR_METRICS = False in settings turns it off.
+import threading
+import time
+
+from tipr import tracing
+
+SECONDS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERIES = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # name -> {labels: Histogram}
+        self.counters = {}  # name -> {labels: value}
+        self.help = {}
+        self.collectors = []  # callables adding counters at scrape time
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    # a finished trace from tracing.py
+    def record(self, trace):
+        endpoint = trace['name']
+        self.observe('tipr_request_seconds', trace['ms'] / 1000, endpoint=endpoint)
+        for span in trace['spans']:
+            self.observe('tipr_phase_seconds', span['ms'] / 1000, endpoint=endpoint, phase=span['name'])
+        counts = trace['counts']
+        self.observe('tipr_db_queries', counts.get('db_queries', 0), QUERIES, endpoint=endpoint)
+        self.observe('tipr_db_seconds', counts.get('db_ms', 0) / 1000, endpoint=endpoint)
+        if 'error' in trace:
+            self.inc('tipr_request_errors_total', endpoint=endpoint)
+
+    def render(self):
+        for collect in self.collectors:
+            collect(self)
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                header(lines, name, 'counter', self.help)
+                for key, value in series.items():
+                    lines.append(f'{name}{labels(key)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                header(lines, name, 'histogram', self.help)
+                for key, histogram in series.items():
+                    total = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append(f'{name}_bucket{labels(key + (("le", bound),))} {total}')
+                    lines.append(f'{name}_sum{labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+def header(lines, name, type, help):
+    if name in help:
+        lines.append(f'# HELP {name} {help[name]}')
+    lines.append(f'# TYPE {name} {type}')
+
+def labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+
+metrics = Metrics()
+metrics.describe('tipr_request_seconds', 'time to handle a request, by endpoint')
+metrics.describe('tipr_phase_seconds', 'time spent in each phase of a request (load, rules, render, save)')
+metrics.describe('tipr_db_queries', 'database queries per request')
+metrics.describe('tipr_db_seconds', 'time spent in database queries per request')
+metrics.describe('tipr_request_errors_total', 'requests that raised')
+metrics.describe('tipr_ticks_total', 'timed updates run, by game type')
+metrics.describe('tipr_rewinds_total', 'games rewound, by game type')
+metrics.describe('tipr_conflicts_total', 'writes that lost to another write of the same game and were redone')
+metrics.describe('tipr_render_cache_total', 'render cache lookups, by kind and result')
+
+def inc(name, amount=1, **labels):
+    metrics.inc(name, amount, **labels)
+
+
+# counts every query onto the running trace, if there is one
+def timed_query(execute, sql, params, many, context):
+    if tracing.current.get() is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        tracing.add('db_queries')
+        tracing.add('db_ms', (time.perf_counter() - start) * 1000)
+
+def wrap_connection(sender, connection, **kwargs):
+    if timed_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timed_query)
+
+def collect_render_cache(metrics):
+    from tipr.render_cache import render_cache
+    with metrics.lock:
+        metrics.counters['tipr_render_cache_total'] = {
+            (('kind', kind), ('result', result)): count for (kind, result), count in render_cache.counts().items()}
+
+installed = False
+
+def install():
+    global installed
+    from django.conf import settings
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    if installed or not getattr(settings, 'TIPR_METRICS', True):
+        return
+    installed = True
+    tracing.listeners.append(metrics.record)
+    metrics.collectors.append(collect_render_cache)
+    connection_created.connect(wrap_connection)
+    for connection in connections.all():
+        wrap_connection(None, connection)
@@ -0,0 +1,70 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def split_history(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    GameEvent = apps.get_model('tipr', 'GameEvent')
+    for game in Game.objects.all():
+        events = []
+        for interval, frames in enumerate(game.history):
+            for seq, frame in enumerate(frames):
+                events.append(GameEvent(game=game, interval=interval, seq=seq, type=frame['type'],
+                                        info=frame['info'], timestamp=frame['timestamp'],
+                                        rewound='rewound' in frame))
+        GameEvent.objects.bulk_create(events)
+        game.interval = len(game.history) - 1
+        game.save()
+
+
+def join_history(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    for game in Game.objects.all():
+        history = [[] for _ in range(game.interval + 1)]
+        for event in game.events.order_by('interval', 'seq'):
+            frame = {'type': event.type, 'info': event.info, 'timestamp': event.timestamp}
+            if event.rewound:
+                frame['rewound'] = True
+            history[event.interval].append(frame)
+        game.history = history
+        game.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tipr', '0002_alter_game_next_tick'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.IntegerField()),
+                ('seq', models.IntegerField()),
+                ('type', models.CharField(max_length=32)),
+                ('info', models.JSONField(null=True)),
+                ('timestamp', models.FloatField()),
+                ('rewound', models.BooleanField(default=False)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='tipr.game')),
+            ],
+            options={
+                'ordering': ['interval', 'seq'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gameevent',
+            constraint=models.UniqueConstraint(fields=('game', 'interval', 'seq'), name='unique_game_event'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='interval',
+            field=models.IntegerField(default=-1),
+        ),
+        migrations.RunPython(split_history, join_history),
+        migrations.RemoveField(
+            model_name='game',
+            name='history',
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tipr', '0003_gameevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gameevent',
+            index=models.Index(fields=['game', 'seq', 'rewound'], name='game_keyframes'),
+        ),
+    ]
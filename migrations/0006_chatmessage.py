@@ -0,0 +1,47 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def split_chat(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    ChatMessage = apps.get_model('tipr', 'ChatMessage')
+    for game in Game.objects.all():
+        ChatMessage.objects.bulk_create([ChatMessage(game=game, timestamp=timestamp, user=user, message=message)
+                                         for timestamp, user, message in game.chat_log])
+
+
+def join_chat(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    for game in Game.objects.all():
+        game.chat_log = [[message.timestamp, message.user, message.message]
+                         for message in game.messages.order_by('pk')]
+        game.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tipr', '0005_game_version_due'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.FloatField()),
+                ('user', models.CharField(max_length=64)),
+                ('message', models.TextField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='tipr.game')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['game', 'id'], name='game_chat'),
+        ),
+        migrations.RunPython(split_chat, join_chat),
+        migrations.RemoveField(
+            model_name='game',
+            name='chat_log',
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seat_players(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    GamePlayer = apps.get_model('tipr', 'GamePlayer')
+    for game in Game.objects.all():
+        names = game.people[0] if game.people else []
+        GamePlayer.objects.bulk_create([GamePlayer(game=game, name=name, seat=seat)
+                                        for seat, name in enumerate(names) if name])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tipr', '0006_chatmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GamePlayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('seat', models.IntegerField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='players', to='tipr.game')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gameplayer',
+            index=models.Index(fields=['name', 'game'], name='player_games'),
+        ),
+        migrations.AddConstraint(
+            model_name='gameplayer',
+            constraint=models.UniqueConstraint(fields=('game', 'seat'), name='unique_game_seat'),
+        ),
+        migrations.RunPython(seat_players, migrations.RunPython.noop),
+    ]
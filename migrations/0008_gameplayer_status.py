@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def copy_status(apps, schema_editor):
+    Game = apps.get_model('tipr', 'Game')
+    GamePlayer = apps.get_model('tipr', 'GamePlayer')
+    for status in Game.objects.values_list('status', flat=True).distinct():
+        GamePlayer.objects.filter(game__status=status).update(status=status)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tipr', '0007_gameplayer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayer',
+            name='status',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RemoveIndex(
+            model_name='gameplayer',
+            name='player_games',
+        ),
+        migrations.AddIndex(
+            model_name='gameplayer',
+            index=models.Index(fields=['name', 'status', 'game'], name='player_status'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['status'], name='game_status'),
+        ),
+        migrations.RunPython(copy_status, migrations.RunPython.noop),
+    ]
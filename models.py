@@ -1,6 +1,12 @@
+import bisect, copy, functools, json, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
+from functools import cached_property
+from tipr import lobby, metrics, tracing
+from tipr.sim import replay
 from tipr.utils import *
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 
 class Game(models.Model):
@@ -12,92 +18,585 @@ class Game(models.Model):
     next_tick = models.IntegerField(null=True)  # seconds from last_tick
     gamestate = models.JSONField(default=dict)
     options = models.JSONField(default=dict)
-    history = models.JSONField(default=list)  # [ [<keyframe>, <event>, ..], ..]
-    chat_log = models.JSONField(default=list)
+    interval = models.IntegerField(default=-1)  # index of the latest keyframe in history
+    version = models.IntegerField(default=0)  # bumped whenever anything a client sees changes, or the row is written
+    due = models.FloatField(null=True)  # when the rules next need to run, None while waiting on moves
 
+    VERSIONED = {'people', 'status', 'gamestate', 'last_tick', 'next_tick'}
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'type'], name='game_status_type')]
+
+    # the status this game's GamePlayer rows have, see sync_players
+    _player_status = None
+    # the version of the row in the database, as far as we know, see write_row
+    _row_version = None
+
+    # someone else wrote the game since we read it
+    class Conflict(Exception):
+        pass
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        game = super().from_db(db, field_names, values)
+        game._player_status = game.__dict__.get('status')
+        game._row_version = game.__dict__.get('version')
+        return game
+
+    # [ [<keyframe>, <event>, ..], ..], read lazily from GameEvent rows
+    @cached_property
+    def history(self):
+        return History(self)
+
+    # unit of work: inside this block save() only marks the game dirty and events are
+    # buffered, then one UPDATE of the changed fields and one INSERT of the events go out at the end
+    _deferred = 0
+
+    @contextmanager
+    def deferred(self):
+        if not self._deferred:
+            self._snapshot = self.snapshot() if self.pk else None
+            self._dirty = False
+            self.pending_events = []
+            self.pending_messages = []
+            self.pending_players = []
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+        if not self._deferred:
+            self.flush()
+
+    def snapshot(self):
+        return {field.attname: json.dumps(getattr(self, field.attname)) if isinstance(field, models.JSONField)
+                else getattr(self, field.attname) for field in self._meta.concrete_fields if not field.primary_key}
+
+    def changed_fields(self, since=None):
+        since = since or self._snapshot
+        current = self.snapshot()
+        return [name for name, value in current.items() if since[name] != value]
+
+    def save(self, *args, **kwargs):
+        if self._deferred:
+            self._dirty = True
+            return
+        created = not self.pk
+        self.write_held_events()
+        if created:
+            super().save(*args, **kwargs)
+            self._row_version = self.version
+        else:
+            self.version += 1
+            self.write_row()
+        self._persisted = None
+        self.sync_players(created)
+
+    def flush(self):
+        with tracing.span('save', events=len(self.pending_events), messages=len(self.pending_messages)):
+            self.flush_pending()
+
+    def flush_pending(self):
+        created = not self.pk
+        if created:
+            super().save()
+            self._row_version = self.version
+        else:
+            changed = self.changed_fields() if self._dirty else []
+            if self.pending_messages or self.VERSIONED.intersection(changed):
+                self.version += 1
+            if self.hold(changed):
+                return
+        self.write(created)
+
+    # write-behind, for games in the hot store (hotstore.py): a unit of work that only ticked the
+    # clock is kept in memory, until a keyframe, a move, chat, a seat or status change, or until
+    # the oldest held tick is write_behind seconds old. then it all goes out in one write, events
+    # first, so the row in the database is always one the events in the database lead to.
+    write_behind = 0  # seconds, 0 = write through
+    held_events = ()
+    _held_since = None
+    _persisted = None  # snapshot of the row as it is in the database, while anything is held
+
+    def hold(self, changed):
+        if not (self.write_behind and self.status == ACTIVE and 'status' not in changed
+                and not self.pending_messages and not self.pending_players
+                and all(event.type == 'time' for event in self.pending_events)):
+            return False
+        if self._held_since is None:
+            self._held_since = time.monotonic()
+        elif time.monotonic() - self._held_since > self.write_behind:
+            return False
+        if self._persisted is None:
+            self._persisted = self._snapshot
+        self.held_events = list(self.held_events) + self.pending_events
+        self.pending_events = []
+        return True
+
+    def holding(self):
+        return self._persisted is not None
+
+    # write what's held now, without waiting for the next unit of work
+    def persist(self):
+        if not self.holding():
+            return
+        fields = self.changed_fields(self._persisted)
+        self.write_held_events()
+        if fields:
+            self.write_row(fields)
+        self._persisted = None
+
+    # write everything held and pending
+    def write(self, created=False):
+        fields = []
+        if not created and (self._dirty or self.holding() or self.pending_messages):
+            fields = self.changed_fields(self._persisted)
+        # events before the game row, so a saved gamestate never gets ahead of its history
+        self.write_held_events()
+        if self.pending_events:
+            self.insert_events(self.pending_events)
+            self.pending_events = []
+        if self.pending_messages:
+            ChatMessage.objects.bulk_create(self.pending_messages)
+            self.pending_messages = []
+        if self.pending_players:
+            for player in self.pending_players:
+                player.status = self.status
+            GamePlayer.objects.bulk_create(self.pending_players)
+            self.pending_players = []
+        self.sync_players(created)
+        if fields:
+            self.write_row(fields)
+        self._persisted = None
+
+    def write_held_events(self):
+        if self.held_events:
+            self.insert_events(self.held_events)
+        self.held_events = ()
+        self._held_since = None
+
+    # events appended but not in the database yet: held (see hold), or pending in a unit of work
+    def unwritten_events(self):
+        return [*self.held_events, *getattr(self, 'pending_events', ())]
+
+    # compare and swap: the row is only written if it's still the version we read, and the version
+    # always moves on, so of two requests that read the same game only the first one's write goes
+    # in. the other gets Conflict, and its transaction has to be rolled back and the work redone
+    # from a fresh read (see views.on_game).
+    def write_row(self, fields=None):
+        if self.version == self._row_version:
+            self.version += 1
+        if fields is None:
+            fields = [field.attname for field in self._meta.concrete_fields if not field.primary_key]
+        values = {name: getattr(self, name) for name in set(fields) | {'version'}}
+        if not Game.objects.filter(pk=self.pk, version=self._row_version).update(**values):
+            raise Game.Conflict(f'game {self.pk} changed since version {self._row_version}')
+        self._row_version = self.version
+
+    # events another request already appended at the same place are a conflict too
+    def insert_events(self, events):
+        try:
+            GameEvent.objects.bulk_create(events)
+        except IntegrityError as e:
+            raise Game.Conflict(f'game {self.pk}: {e}')
+
+    # GamePlayer.status is a copy of status, so lookups by player never need the game rows.
+    # the lobby hears about new games, seats and status changes.
+    _seated = False
+
+    def sync_players(self, created=False):
+        changed = self.status != self._player_status
+        if changed and not created:
+            GamePlayer.objects.filter(game=self).update(status=self.status)
+        if created or changed or self._seated:
+            kind = 'added' if created else 'removed' if self.status == FINISHED else 'changed'
+            lobby.publish(kind, lobby.game_row(self))
+        self._player_status = self.status
+        self._seated = False
+
+    # unfinished games name is sitting in
+    @staticmethod
+    def games_of(name):
+        return Game.objects.filter(pk__in=GamePlayer.objects.filter(name=name, status__lt=FINISHED).values('game'))
+
+    # games still waiting for players
+    @staticmethod
+    def open_seats():
+        return Game.objects.filter(status=CREATED)
+
+    # ids of active games with any of these players in them
+    @staticmethod
+    def active_with(names):
+        return GamePlayer.objects.filter(name__in=names, status=ACTIVE).values_list('game', flat=True).distinct()
+
+    # chat lives in its own table, so a message only bumps the version instead of rewriting the game
     def chat(self, user, message, timestamp=None):
         if not timestamp:
             timestamp = tznow()
-        self.chat_log.append([timestamp.timestamp(), user, message])
-        self.save()
+        message = ChatMessage(game=self, timestamp=timestamp.timestamp(), user=user, message=message)
+        if self._deferred:
+            self.pending_messages.append(message)
+            return
+        message.save()
+        Game.objects.filter(pk=self.pk).update(version=models.F('version') + 1)
+        self.version += 1
+        self._row_version += 1
+
+    # seat a player. GamePlayer mirrors people[0] so finding someone's games is an index lookup
+    def sit(self, name, seat):
+        self.people[0][seat] = name
+        self.people[1][seat] = True
+        player = GamePlayer(game=self, name=name, seat=seat)
+        self._seated = True
+        if self._deferred:
+            self.pending_players.append(player)
+        else:
+            player.save()
 
+    # the last CHAT_WINDOW messages, or at most that many after the cursor (a ChatMessage id)
+    def chat_since(self, cursor=None):
+        messages = self.messages.order_by('-pk')
+        if cursor is not None:
+            messages = messages.filter(pk__gt=cursor)
+        return list(reversed(messages[:CHAT_WINDOW]))
+
+    # events and keyframes are single appended rows; the caller saves the game itself
     def event(self, type, info, timestamp=None):
         if not timestamp:
             timestamp = tznow()
-        self.history[-1].append({'type': type,
-                                 'info': info,
-                                 'timestamp': timestamp.timestamp()})
-        self.save()
+        self.history.append(type, info, timestamp)
 
     def keyframe(self):
-        timestamp = tznow()
-        self.history.append([{'type': 'keyframe',
-                              'info': self.gamestate,
-                              'timestamp': timestamp.timestamp()}])
-        self.save()
+        if not self.pk:
+            self.save()
+        self.interval += 1
+        self.history.append('keyframe', self.gamestate, tznow())
 
-    # reinflate history at a non-keyframe point in time
-    # interval_idx: keyframe to start from, as an index into the history list
-    # count: number of states forward from keyframe to include. 0 = all for this keyframe.
-    # last_only: just the specified state if True, all starting at keyframe if False
+    # see utils.intermediate_states
     @staticmethod
     def intermediate_states(history, interval_idx, count=0, last_only=False):
-        try:
-            # rewinds are part of linear history, but not part of blessed history. exclude them.
-            interval = list(filter(lambda interval: 'rewound' not in interval[0], history))[interval_idx]
-        # 
-        except IndexError:
-            return None
-        frame = interval[0]
-        if not last_only:
-            ret = [frame]
-        if count == 0:
-            count = len(interval)
-        for i in range(1, count):
-            frame = update(frame, interval[i])
-            if not last_only:
-                ret.append(frame)
-        if not last_only:
-            return ret
-        return Box(frame)
-
-    def response(self, prepared_gamestate, now, full=False):
-        if not self.last_tick:
-            self.last_tick = now
-            self.save()
-        if self.status != ACTIVE:
-            duration = 0
-            remaining = 0
-        elif not self.next_tick:
-            duration = 0
-            remaining = 0
-        else:
-            duration = self.next_tick
-            remaining = duration - ((now - self.last_tick).seconds) #round(duration - ((now - self.last_tick).seconds + (now - self.last_tick).microseconds / 1000000), 2)
-            if remaining <= 0:
-                remaining = 1
+        return intermediate_states(history, interval_idx, count, last_only)
+
+    # chat: ChatMessage rows the caller already has, instead of reading them again
+    def response(self, prepared_gamestate, now, full=False, chat=None):
+        duration, remaining = Game.timer(self.status, self.last_tick, self.next_tick, now)
+        if chat is None:
+            chat = self.chat_since()
         return Box({
             'timer_duration': duration,
             'time_remaining': remaining,
             'gamestate': prepared_gamestate,  # has meta.deck = {'name': {type, stage, text}} if full
-            'chat': self.chat_log,#[-50:],
-            'options': self.options if full else {},
+            'chat': [message.line() for message in chat],
+            'options': {k: v for k, v in self.options.items() if k != 'seed'} if full else {},
             'people': self.people[0],
         })
 
+    # (duration, remaining) for the timer display. static so it works on a values() row
+    @staticmethod
+    def timer(status, last_tick, next_tick, now):
+        if status != ACTIVE or not next_tick or last_tick is None:
+            return 0, 0
+        remaining = next_tick - ((now - last_tick).seconds) #round(duration - ((now - last_tick).seconds + (now - last_tick).microseconds / 1000000), 2)
+        if remaining <= 0:
+            remaining = 1
+        return next_tick, remaining
+
     def rewind(self, keyframes, reason):
-        blessed_history = list(filter(lambda interval: 'rewound' not in interval[0], self.history))
-        self.gamestate = blessed_history[-(keyframes+1)][0]['info']
-        for i in range(1, keyframes+1):
-            self.history[-i][0]['rewound'] = True
+        metrics.inc('tipr_rewinds_total', type=self.type)
+        self.gamestate = copy_state(self.history.blessed_interval(-(keyframes+1))[0]['info'])
+        self.history.mark_rewound(keyframes)
         if self.status == ACTIVE:
             now = tznow()
             self.last_tick = now
             self.next_tick = -1
+            self.due = now.timestamp()
             self.chat('system', reason, now)
             self.event('rewind', reason, now)
         self.save()
 
+    # [[interval, seq, seat, move], ..] for sim.replay, or None if a move was stored without its seat
+    def move_log(self, events=None):
+        if events is None:
+            events = self.events.filter(type='move')
+        moves = [[e.interval, e.seq, e.info.get('seat'), e.info.get('move')] for e in events
+                 if e.type == 'move' and isinstance(e.info, dict)]
+        if len(moves) != sum(e.type == 'move' for e in events) or any(m[2] is None for m in moves):
+            return None
+        return moves
+
+    # a finished, seeded game keeps only its move events; History rebuilds the rest on demand by
+    # replaying them. only done when the replay ends in exactly the stored state.
+    def compact(self):
+        if self.status != FINISHED or 'seed' not in self.options or 'compacted' in self.options:
+            return False
+        events = list(self.events.all())
+        moves = self.move_log(events)
+        if moves is None or any(e.rewound or e.type == 'rewind' for e in events):
+            return False
+        sim = replay(self.type, self.options, moves)
+        if sim.error or len(sim.game.history) != len(self.history) or \
+                json.dumps(sim.game.gamestate, sort_keys=True) != json.dumps(self.gamestate, sort_keys=True):
+            logging.warning(f'game {self.pk} does not replay from its moves, not compacting: {sim.error}')
+            return False
+        self.options['compacted'] = {'keyframes': [e.timestamp for e in events if e.seq == 0]}
+        with transaction.atomic():
+            self.events.exclude(type='move').delete()
+            Game.objects.filter(pk=self.pk).update(options=self.options)
+        self.__dict__.pop('history', None)
+        return True
+
+    @staticmethod
+    def compact_by_id(id):
+        game = Game.objects.filter(pk=id, status=FINISHED).first()
+        return bool(game and game.compact())
+
     # this takes a timestamp instead of checking the time because we might be in a replay
     def has_ticked(self, timestamp):
         return timestamp - self.last_tick > timedelta(seconds=self.next_tick)
+
+
+CHAT_WINDOW = 100
+
+
+class ChatMessage(models.Model):
+
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='messages')
+    timestamp = models.FloatField()
+    user = models.CharField(max_length=64)
+    message = models.TextField()
+
+    class Meta:
+        indexes = [models.Index(fields=['game', 'id'], name='game_chat')]
+
+    # the old chat_log format
+    def line(self):
+        return [self.timestamp, self.user, self.message]
+
+
+# one row per seated player, see Game.sit
+class GamePlayer(models.Model):
+
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='players')
+    name = models.CharField(max_length=64)
+    seat = models.IntegerField()
+    status = models.IntegerField(default=CREATED)  # the game's, see Game.sync_players
+
+    class Meta:
+        indexes = [models.Index(fields=['name', 'status', 'game'], name='player_status')]
+        constraints = [models.UniqueConstraint(fields=['game', 'seat'], name='unique_game_seat')]
+
+
+class GameEvent(models.Model):
+
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='events')
+    interval = models.IntegerField()  # which keyframe this event follows
+    seq = models.IntegerField()  # 0 is the keyframe itself
+    type = models.CharField(max_length=32)
+    info = models.JSONField(null=True)
+    timestamp = models.FloatField()
+    rewound = models.BooleanField(default=False)  # only set on keyframes
+
+    class Meta:
+        ordering = ['interval', 'seq']
+        indexes = [models.Index(fields=['game', 'seq', 'rewound'], name='game_keyframes')]
+        constraints = [models.UniqueConstraint(fields=['game', 'interval', 'seq'], name='unique_game_event')]
+
+    def json(self):
+        ret = {'type': self.type,
+               'info': self.info,
+               'timestamp': self.timestamp}
+        if self.rewound:
+            ret['rewound'] = True
+        return ret
+
+
+# reinflated frames shared between requests: (game id, interval, offset) -> frame.
+# an interval only ever grows, so a frame at a given offset never changes, as long as the events
+# it was built from were committed: frames go in when the transaction that built them commits.
+# request threads and the scheduler's all use it, so everything goes through the lock
+reinflated = OrderedDict()
+reinflated_lock = threading.Lock()
+REINFLATED_MAX = 512
+
+# the frame, not a copy, or None
+def cached_frame(key):
+    with reinflated_lock:
+        frame = reinflated.get(key)
+        if frame is not None:
+            reinflated.move_to_end(key)
+        return frame
+
+def remember_frame(key, frame):
+    with reinflated_lock:
+        reinflated[key] = frame
+        if len(reinflated) > REINFLATED_MAX:
+            reinflated.popitem(last=False)
+
+# drop a game's frames. for the hot store (hotstore.py) to call when it drops a game whose held
+# events never made it to the database, so frames built from them don't outlive them
+def forget_frames(pk):
+    with reinflated_lock:
+        for key in [key for key in reinflated if key[0] == pk]:
+            del reinflated[key]
+
+
+# list-like view of a game's history, loading intervals from GameEvent on demand
+# so the usual case (last keyframe, current interval) never reads the whole game
+class History(object):
+
+    def __init__(self, game):
+        self.game = game
+        self.intervals = {}
+        self._blessed = None  # interval indices of non-rewound keyframes
+        self._times = None  # their timestamps, for lookup by time
+        self._next_seq = {}  # interval -> seq of the next event appended to it
+
+    def __len__(self):
+        return self.game.interval + 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        if idx not in self.intervals:
+            if 'compacted' in self.game.options:
+                self.load()
+            else:
+                self.intervals[idx] = [event.json() for event in self.events(interval=idx)]
+        return self.intervals[idx]
+
+    def __iter__(self):
+        if len(self.intervals) < len(self):
+            self.load()
+        return (self.intervals[i] for i in range(len(self)))
+
+    def load(self):
+        if 'compacted' in self.game.options:
+            self.intervals = dict(enumerate(self.replayed()))
+            return
+        self.intervals = {i: [] for i in range(len(self))}
+        for event in self.events():
+            self.intervals[event.interval].append(event.json())
+
+    # the game's events, written or not
+    def events(self, **filters):
+        events = list(self.game.events.filter(**filters))
+        for event in self.game.unwritten_events():
+            if all(getattr(event, name) == value for name, value in filters.items()):
+                events.append(event)
+        return events
+
+    # the history of a compacted game, rebuilt from its moves. updates get the time of whatever
+    # came before them; keyframes and moves keep their own.
+    def replayed(self):
+        events = list(self.game.events.filter(type='move'))
+        history = replay(self.game.type, self.game.options, self.game.move_log(events)).game.history
+        times = {(e.interval, e.seq): e.timestamp for e in events}
+        timestamp = None
+        for i, interval in enumerate(history):
+            interval[0]['timestamp'] = timestamp = self.game.options['compacted']['keyframes'][i]
+            for seq, event in enumerate(interval[1:], 1):
+                event['timestamp'] = timestamp = times.get((i, seq), timestamp)
+        return history
+
+    def load_index(self):
+        if 'compacted' in self.game.options:
+            self._times = list(self.game.options['compacted']['keyframes'])
+            self._blessed = list(range(len(self._times)))
+            return
+        self._blessed, self._times = [], []
+        for interval, timestamp in (self.game.events.filter(seq=0, rewound=False)
+                                    .values_list('interval', 'timestamp')):
+            self._blessed.append(interval)
+            self._times.append(timestamp)
+
+    @property
+    def blessed(self):
+        if self._blessed is None:
+            self.load_index()
+        return self._blessed
+
+    def blessed_interval(self, idx):
+        return self[self.blessed[idx]]
+
+    # blessed index of the keyframe in effect at timestamp, or None if it's before the game
+    def blessed_at(self, timestamp):
+        if self._times is None:
+            self.load_index()
+        idx = bisect.bisect_right(self._times, timestamp) - 1
+        return idx if idx >= 0 else None
+
+    def frame(self, interval_idx, offset):
+        interval = self[interval_idx]
+        key = (self.game.pk, interval_idx, offset)
+        if (frame := cached_frame(key)) is not None:
+            return copy_state(frame)
+        # the nearest earlier frame to start from, or the keyframe
+        start, base = offset - 1, None
+        while start > 0 and (base := cached_frame((self.game.pk, interval_idx, start))) is None:
+            start -= 1
+        if base is None:
+            start, base = 0, interval[0]
+        frame = self.frame_from(copy_state(base), interval, start, offset)
+        transaction.on_commit(functools.partial(remember_frame, key, copy_state(frame)))
+        return frame
+
+    @staticmethod
+    def frame_from(frame, interval, start, offset):
+        for i in range(start + 1, offset + 1):
+            frame = update(frame, stored_delta(interval[i]))
+        return frame
+
+    # utils.intermediate_states, using the keyframe index and the reinflation cache
+    def intermediate_states(self, interval_idx, count=0, last_only=False):
+        try:
+            interval_idx = self.blessed[interval_idx]
+        except IndexError:
+            return None
+        interval = self[interval_idx]
+        if count == 0:
+            count = len(interval)
+        if last_only:
+            return Box(self.frame(interval_idx, count - 1))
+        return [self.frame(interval_idx, i) for i in range(count)]
+
+    def append(self, type, info, timestamp):
+        interval = self.game.interval
+        if type == 'keyframe':
+            self.intervals[interval] = []
+            if self._blessed is not None:
+                self._blessed.append(interval)
+                self._times.append(timestamp.timestamp())
+        seq = self.next_seq(interval)
+        # a copy, as the database will have it: the keyframe is the game's own gamestate, which
+        # goes on changing, and a held event (see Game.hold) is written later
+        event = GameEvent(game=self.game, interval=interval, seq=seq, type=type,
+                          info=json.loads(json.dumps(info)), timestamp=timestamp.timestamp())
+        if self.game._deferred:
+            self.game.pending_events.append(event)
+        else:
+            event.save()
+        self._next_seq[interval] = seq + 1
+        if interval in self.intervals:
+            self.intervals[interval].append(event.json())
+
+    # without loading the interval, which every tick would otherwise do just to count it
+    def next_seq(self, interval):
+        if interval in self.intervals or 'compacted' in self.game.options:
+            return len(self[interval])
+        if interval not in self._next_seq:
+            last = self.game.events.filter(interval=interval).aggregate(models.Max('seq'))['seq__max']
+            seqs = [event.seq for event in self.game.unwritten_events() if event.interval == interval]
+            self._next_seq[interval] = max([-1 if last is None else last, *seqs]) + 1
+        return self._next_seq[interval]
+
+    # rewinds are part of linear history, but not part of blessed history
+    def mark_rewound(self, keyframes):
+        first = len(self) - keyframes
+        self.game.events.filter(seq=0, interval__gte=first).update(rewound=True)
+        for i in range(max(first, 0), len(self)):
+            self[i][0]['rewound'] = True
+        self._blessed = self._times = None
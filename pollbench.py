@@ -0,0 +1,189 @@
+# how many clients polling games at 8 fps one worker keeps up with, the sync views against the async
+# ones (views.Async*). runs in one process, through Django's ASGI handler with no server, against the
+# configured database, where it makes its own games.
+#
+#   DJANGO_SETTINGS_MODULE=tipr.settings python -m tipr.pollbench --clients 100,500,1000 --seconds 5
+#
+# clients poll the way the update worker does, sending the version they have, and the tick scheduler
+# runs as it would in a deployment, so nearly every poll is an unchanged one. a level keeps up if the
+# polls made are within 5% of what was asked for and the p95 latency is under a frame.
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+
+class Response(object):
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+# an HTTP client for an ASGI app in the same process. keeps its cookies, like a browser tab.
+class Client(object):
+    def __init__(self, app, cookies=None):
+        self.app = app
+        self.cookies = dict(cookies or {})
+
+    async def request(self, method, path, query=None, data=None, headers=None):
+        body = urlencode(data).encode() if data is not None else b''
+        head = [(b'host', b'testserver')]
+        if self.cookies:
+            head.append((b'cookie', '; '.join(f'{key}={value}' for key, value in self.cookies.items()).encode()))
+        if data is not None:
+            head.append((b'content-type', b'application/x-www-form-urlencoded'))
+            head.append((b'content-length', str(len(body)).encode()))
+        head.extend((key.lower().encode(), value.encode()) for key, value in (headers or {}).items())
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                 'query_string': urlencode(query or {}).encode(), 'headers': head,
+                 'client': ('127.0.0.1', 0), 'server': ('testserver', 80)}
+        finished = asyncio.Event()
+        received = False
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+        start, chunks = {}, []
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            finished.set()
+        headers = {}
+        for key, value in start.get('headers', []):
+            key, value = key.decode().lower(), value.decode()
+            if key == 'set-cookie':
+                for morsel in SimpleCookie(value).values():
+                    self.cookies[morsel.key] = morsel.value
+            headers[key] = value
+        return Response(start.get('status'), headers, b''.join(chunks))
+
+    async def get(self, path, query=None, headers=None):
+        return await self.request('GET', path, query, headers=headers)
+
+    async def post(self, path, data, headers=None):
+        return await self.request('POST', path, data=data, headers=headers)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+# p50/p95/p99 of seconds, in ms
+def latencies(seconds):
+    return {f'p{p}': round(percentile(seconds, p) * 1000, 2) if seconds else None for p in (50, 95, 99)}
+
+
+# games of two registered players each, and the session cookies of some registered spectators
+async def setup(app, games, spectators):
+    game_ids = []
+    for n in range(games):
+        players = [Client(app), Client(app)]
+        for seat, player in enumerate(players):
+            await player.get('/')
+            await player.post('/register/', {'name': f'bench{n}p{seat}'})
+        game = (await players[0].post('/sit/', {'seat': 0, 'type': 'rps'})).json()['game']
+        await players[1].post('/sit/', {'seat': 1, 'game': game})
+        game_ids.append(game)
+    sessions = []
+    for n in range(spectators):
+        spectator = Client(app)
+        await spectator.get('/')
+        await spectator.post('/register/', {'name': f'benchwatcher{n}'})
+        sessions.append(spectator.cookies)
+    return game_ids, sessions
+
+# one tab polling a game fps times a second until stop, with the version it was last sent
+async def poll(app, prefix, game, cookies, fps, stop, seconds, errors):
+    client = Client(app, cookies)
+    interval = 1 / fps
+    version = None
+    path = f'{prefix}/update/{game}/'
+    # tabs aren't opened in step with each other
+    next_poll = time.perf_counter() + random.uniform(0, interval)
+    while next_poll < stop:
+        await asyncio.sleep(max(next_poll - time.perf_counter(), 0))
+        start = time.perf_counter()
+        try:
+            response = await client.get(path, {'version': version} if version is not None else {})
+            if response.status == 200:
+                version = response.json().get('version', version)
+            elif response.status != 304:
+                errors.append(response.status)
+        except Exception as e:
+            errors.append(repr(e))
+        seconds.append(time.perf_counter() - start)
+        next_poll += interval
+
+async def level(app, prefix, game_ids, sessions, clients, fps, duration):
+    seconds, errors = [], []
+    stop = time.perf_counter() + duration
+    games, cookies = itertools.cycle(game_ids), itertools.cycle(sessions or [{}])
+    started = time.perf_counter()
+    await asyncio.gather(*(poll(app, prefix, next(games), next(cookies), fps, stop, seconds, errors)
+                           for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    asked = clients * fps * duration
+    result = {'views': prefix.strip('/'), 'clients': clients, 'polls/s': round(len(seconds) / elapsed, 1),
+              'asked/s': clients * fps, 'errors': len(errors), **latencies(seconds)}
+    result['keeps up'] = (len(seconds) >= asked * .95 and not errors and
+                          percentile(seconds, 95) is not None and percentile(seconds, 95) < 1 / fps)
+    return result
+
+async def bench(levels, fps, duration, games, spectators):
+    from django.core.asgi import get_asgi_application
+    from tipr.scheduler import ticker
+    app = ticker.middleware(get_asgi_application())
+    game_ids, sessions = await setup(app, games, spectators)
+    capacity = {}
+    for prefix in ('/sync', '/async'):
+        capacity[prefix] = 0
+        for clients in levels:
+            result = await level(app, prefix, game_ids, sessions, clients, fps, duration)
+            print(json.dumps(result))
+            if not result['keeps up']:
+                break
+            capacity[prefix] = clients
+    return capacity
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='concurrent pollers one worker keeps up with, sync views against async')
+    parser.add_argument('--clients', default='50,100,250,500,1000,2000', help='comma separated levels to try, in order')
+    parser.add_argument('--fps', type=float, default=8)
+    parser.add_argument('--seconds', type=float, default=5, help='at each level')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--spectators', type=int, default=50, help='registered sessions the clients share')
+    parser.add_argument('--hot', action='store_true', help='with TIPR_HOT_STORE on')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from django.conf import settings
+    settings.TIPR_TICK_SCHEDULER = True
+    if args.hot:
+        settings.TIPR_HOT_STORE = True
+    # the rules log at warning level
+    logging.disable(logging.WARNING)
+    levels = [int(clients) for clients in args.clients.split(',')]
+    capacity = asyncio.run(bench(levels, args.fps, args.seconds, args.games, args.spectators))
+    print(f'clients kept up with at {args.fps:g} fps: sync {capacity["/sync"]}, async {capacity["/async"]}')
@@ -0,0 +1,57 @@
+# name -> class tables for everything gamestate refers to by name: cards, badges and restrictions.
+# classes register themselves when they're defined (see __init_subclass__ in rps_cards), so the
+# generated curses and cards from plugin modules are found the same way as the built in ones.
+import importlib
+import os
+
+cards = {}
+badges = {}
+restrictions = {}
+
+# card name -> {ability_number: ability}, see RPSCard.init
+abilities = {}
+
+# card modules to import besides rps_cards, comma separated
+PLUGINS_ENV = 'TIPR_CARD_PLUGINS'
+
+
+def register(table, cls):
+    name = cls.__name__
+    if table.get(name, cls) is not cls:
+        raise ValueError(f'{name} is already registered by {table[name].__module__}')
+    table[name] = cls
+    return cls
+
+def register_card(cls):
+    register(cards, cls)
+    abilities[cls.__name__] = cls.abilities
+    return cls
+
+def card(name):
+    return cards[name]
+
+def badge(name):
+    return badges[name]
+
+def restriction(name):
+    return restrictions[name]
+
+# {slot: [card class, ..]}
+def cards_by_slot():
+    slots = {}
+    for cls in cards.values():
+        if hasattr(cls, 'slot'):
+            slots.setdefault(cls.slot, []).append(cls)
+    return slots
+
+
+loaded_plugins = set()
+
+# import card modules so their classes register. modules default to $TIPR_CARD_PLUGINS.
+def load_plugins(modules=None):
+    if modules is None:
+        modules = [m.strip() for m in os.environ.get(PLUGINS_ENV, '').split(',') if m.strip()]
+    for module in modules:
+        if module not in loaded_plugins:
+            importlib.import_module(module)
+            loaded_plugins.add(module)
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Rendered HTML shared between everyone looking at the same thing, e.g.
+# (game id, seat role, version) -> board. Bounded LRU with a TTL, safe across threads.
+class RenderCache(object):
+
+    def __init__(self, size=2048, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.kinds = {}  # (key[0], 'hit' | 'miss') -> count, e.g. ('board', 'hit')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                self.count(key, 'miss')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.count(key, 'hit')
+            return entry[1]
+
+    def count(self, key, result):
+        kind = (key[0] if isinstance(key, tuple) else 'other', result)
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # two threads missing at once both render; the result is the same either way
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def counts(self):
+        with self.lock:
+            return dict(self.kinds)
+
+
+render_cache = RenderCache()
@@ -1,10 +1,14 @@
+import copy
 import functools
-import logging
-from random import choice, shuffle
+import json
+import random
+from tipr import registry, tracing
 from tipr.utils import *
 from tipr.rps_cards import *
 from tipr.rules import Rules
 
+registry.load_plugins()
+
 
 class RPSRules(Rules):
 
@@ -15,7 +19,10 @@ class RPSRules(Rules):
         'timer': 7,
         'player_count': 2,
         'fps': 8,
+        'fast_resolve': False,  # resolve all of stage 4 in one update, see resolve_round
     }
+    # a stage 4 chain is a handful of abilities per card; this only stops a broken card looping
+    MAX_CHAIN = 64
     stage_dict = {'1': [], '2': [], '3': []}
 
     def player_state(self, options):
@@ -30,9 +37,9 @@ class RPSRules(Rules):
             'badges_used': [],  # remembering during ability resolution
             'shields': {'n': 0, 'this_turn': 0},
             'restrictions': [],  # [[Name, Arg, Source ("<ability> @ round #"), Duration], ..]
-            'stages': RPSRules.stage_dict,
+            'stages': copy.deepcopy(RPSRules.stage_dict),
             'cards': [{'name': card.__name__, 'level': 1, 'cracked': False, 'type': card.type, 'slot': card.slot}
-                      for card in map(lambda name: globals()[name], options['deck'])]
+                      for card in map(registry.card, options['deck'])]
         }
 
     def start_state(self, options):
@@ -49,19 +56,16 @@ class RPSRules(Rules):
         return starting_state
 
     @staticmethod
-    def deck():
-        card_classes = [[] for _ in range(11)]
-        for cls in RPSCard.__subclasses__():
-            if hasattr(cls, 'slot'):
-                card_classes[cls.slot].append(cls)
-        return [choice(card_classes[x]).__name__ for x in range(11)]
+    def deck(rng=random):
+        card_classes = registry.cards_by_slot()
+        return [rng.choice(card_classes[x]).__name__ for x in range(11)]
 
 
     @staticmethod
     @functools.cache
     def deck_text(game):
         return [Box({'name': card.__name__, 'slot': card.slot, 'text': card.text})
-                for card in RPSCard.__subclasses__() if card.__name__ in game.options['deck']]
+                for card in registry.cards.values() if card.__name__ in game.options['deck']]
 
     def get_selections(self, gamestate, seats=seats):
         ret = []
@@ -102,7 +106,7 @@ class RPSRules(Rules):
                 if 'revealed' not in card:
                     gamestate[other].cards[card.slot] = history[-1][0]['info'][other]['cards'][card.slot]
             gamestate[other].selection = {}
-            gamestate[other].stages = RPSRules.stage_dict
+            gamestate[other].stages = copy.deepcopy(RPSRules.stage_dict)
         return gamestate
 
     def should_update(self, game, gamestate, timestamp):
@@ -110,10 +114,24 @@ class RPSRules(Rules):
                 and game.last_tick and game.has_ticked(timestamp)) or \
                (gamestate.meta.stage < 4 and any(gamestate.p1.stages.values()) and any(gamestate.p2.stages.values()))
      
+    def timed(self, game, gamestate):
+        return game.options.get('timed') or gamestate.meta.stage == 4
+
     def do_update(self, game):
-        return self.pure_update(Box(game.options), Box(game.gamestate), game.history)
+        return self.pure_update(Box(game.options), Box(game.gamestate), game.history, self.rng(game))
 
-    def pure_update(self, options, gamestate, history):
+    def rng(self, game):
+        return self.state_rng(game.options, game.gamestate)
+
+    # game_rng without fast_resolve's meta.timeline, which a ticked round never has, so both roll
+    # the same from the same state
+    @staticmethod
+    def state_rng(options, gamestate):
+        if 'timeline' in gamestate['meta']:
+            gamestate = {**gamestate, 'meta': {k: v for k, v in gamestate['meta'].items() if k != 'timeline'}}
+        return game_rng(options, gamestate)
+
+    def pure_update(self, options, gamestate, history, rng=random):
         delta = empty_delta()
         match gamestate.meta.stage:
             case 1 | 2 as st:
@@ -140,7 +158,7 @@ class RPSRules(Rules):
                             case x, y if x == y:
                                 order = [p1, p2]
                                 if gamestate.p1.hp == gamestate.p2.hp and gamestate.p1.coins == gamestate.p2.coins:
-                                    shuffle(order)
+                                    rng.shuffle(order)
                                 elif gamestate.p1.hp == gamestate.p2.hp:
                                     order.sort(key=lambda box: gamestate[box.seat].coins, reverse=True)
                                 else:
@@ -167,13 +185,13 @@ class RPSRules(Rules):
                                {'slot': happens_first.slot,
                                 'timing': happens_first.timing,
                                 # 'stage': when it was chosen
-                                'ability_number': len(globals()[options.deck[happens_first.slot]].ability_order) + 3}}})
+                                'ability_number': len(registry.card(options.deck[happens_first.slot]).ability_order) + 3}}})
                 add_message(delta, msg)
                 if happens_second.owner:
                     update(delta, {happens_second.owner: {'selection':
                         {'slot': happens_second.slot,
                          'timing': 0,
-                         'ability_number': len(globals()[options.deck[happens_second.slot]].ability_order) + 3}}})
+                         'ability_number': len(registry.card(options.deck[happens_second.slot]).ability_order) + 3}}})
                 else:  # the card won't happen, but we might need the name
                     delta.ga(opp(happens_first.owner)).selection = {'slot': loser.card.slot, 'ability_number': 0}
                 for seat in seats:
@@ -184,36 +202,74 @@ class RPSRules(Rules):
                                                    restriction.duration != 1]
                 return delta
 
+            case 4 if options.get('fast_resolve'):
+                return self.resolve_round(options, gamestate, history)
             case 4:
-                outcome = gamestate.meta.outcome
-                active_player = outcome.player
-                inactive_player = opp(active_player)
-                if (selection := gamestate.get(active_player).selection).ability_number:
-                    resolving_player = active_player
+                return self.resolve_step(options, gamestate, history, rng)
+
+    # one stage 4 tick: the next ability of the next selection, or the end of the round
+    def resolve_step(self, options, gamestate, history, rng):
+        delta = empty_delta()
+        outcome = gamestate.meta.outcome
+        active_player = outcome.player
+        inactive_player = opp(active_player)
+        if (selection := gamestate.get(active_player).selection).ability_number:
+            resolving_player = active_player
+        else:
+            if not (selection := gamestate.get(inactive_player).selection).ability_number:  # done
+                round = gamestate.meta.round
+                delta.meta = {'round': round + 1, 'outcome': 'del'}
+                if options.timed:
+                    delta.meta.stage = 1
                 else:
-                    if not (selection := gamestate.get(inactive_player).selection).ability_number:  # done
-                        round = gamestate.meta.round
-                        delta.meta = {'round': round + 1, 'outcome': 'del'}
-                        if options.timed:
-                            delta.meta.stage = 1
-                        else:
-                            delta.meta.stage = 3
-                        for seat in seats:
-                            delta.ga(seat).stages = {'replace': RPSRules.stage_dict}
-                            delta.get(seat).selection = {'replace': {}}
-                            delta.get(seat).ga('shields').this_turn = 0
-
-                        add_message(delta, f'round {round} ends')
-                        logging.warn(f"ONE: {delta}")
-                        return delta
-                    else:
-                        resolving_player = inactive_player
-
-                # card updates its own stage so it can skip stuff, etc
-                card = globals()[gamestate.get(resolving_player).cards[selection.slot].name]
-                result = card.apply(gamestate, history, resolving_player)
-                logging.warn(f"{delta}\n--\n{result}")
-                return update(delta, result)
+                    delta.meta.stage = 3
+                for seat in seats:
+                    delta.ga(seat).stages = {'replace': copy.deepcopy(RPSRules.stage_dict)}
+                    delta.get(seat).selection = {'replace': {}}
+                    delta.get(seat).ga('shields').this_turn = 0
+
+                add_message(delta, f'round {round} ends')
+                tracing.event('round end', delta=lambda: delta)
+                return delta
+            else:
+                resolving_player = inactive_player
+
+        # card updates its own stage so it can skip stuff, etc
+        card = registry.card(gamestate.get(resolving_player).cards[selection.slot].name)
+        result = card.apply(gamestate, history, resolving_player, rng)
+        tracing.event('ability', seat=resolving_player, card=card.__name__, delta=lambda: delta, result=lambda: result)
+        return update(delta, result)
+
+    # fast_resolve: every stage 4 tick in one update. each step is applied exactly as a separate
+    # tick would be, rolling from the state it starts from as that tick would, and recorded in
+    # meta.timeline for the client to play back. the rest of the round's history is one keyframe
+    # instead of an event per ability.
+    def resolve_round(self, options, gamestate, history):
+        round = gamestate.meta.round
+        messages = list(gamestate.meta.message)
+        steps = []
+        for _ in range(self.MAX_CHAIN):
+            before = {seat: gamestate[seat].selection.get('ability_number', 0) for seat in seats}
+            step = self.resolve_step(options, gamestate, history, self.state_rng(options, gamestate))
+            entry = {'seat': None, 'card': None, 'ability': 'end'}
+            for seat in seats:
+                if (step.get(seat) or {}).get('selection', {}).get('ability_number', before[seat]) < before[seat]:
+                    name = gamestate[seat].cards[gamestate[seat].selection.slot].name
+                    entry = {'seat': seat, 'card': name, 'ability': registry.card(name).abilities[before[seat]].__name__}
+            # what storing the state between ticks would do
+            gamestate = Box(json.loads(json.dumps(update(gamestate, step))))
+            entry.update(delta=json.loads(json.dumps(step)), messages=gamestate.meta.message,
+                         hp=[gamestate.p1.hp, gamestate.p2.hp])
+            steps.append(entry)
+            messages.extend(gamestate.meta.message)
+            gamestate.meta.message = []
+            if gamestate.meta.round != round:
+                break
+        else:
+            raise RuntimeError(f'stage 4 did not finish in {self.MAX_CHAIN} steps')
+        gamestate.meta.message = messages
+        gamestate.meta.timeline = {'round': round, 'steps': steps}
+        return {key: {'replace': value} for key, value in gamestate.items()}
 
     def winner(self, gamestate):
         p1_dead = gamestate.p1.hp <= 0
@@ -230,8 +286,7 @@ class RPSRules(Rules):
             return None
 
     def get_restrictions(self, gamestate, seat):
-        return [next(filter(lambda c: c.__name__ == rest['name'],
-                            Restriction.__subclasses__()))(rest['arg'], rest['source'], rest['duration'])
+        return [registry.restriction(rest['name'])(rest['arg'], rest['source'], rest['duration'])
                 for rest in gamestate.get(seat).get('restrictions')]
 
     def move(self, game, seat, move):
@@ -271,21 +326,21 @@ class RPSRules(Rules):
         if move.selection == -1:
             return update(delta, {seat: {'stages': {'pass': 1}}})
         stage = move.selection // 3 + 1
-        delta.ga(seat).stages = {n: [{'kind': 'RPS', 'slot': move.selection}] if n == stage else [] for n in range(1,4)}
+        delta.ga(seat).stages = {str(n): [{'kind': 'RPS', 'slot': move.selection}] if n == stage else [] for n in range(1,4)}
         return delta
 
     def next_tick(self, game):
         stage = game.gamestate['meta']['stage']
         if stage <= 3:
             return game.options['timer']
-        elif stage == 4 and not game.gamestate['meta']['message']:
+        elif stage == 4 and (not game.gamestate['meta']['message'] or game.options.get('fast_resolve')):
             return 0
         else:
             return 2
 
-    def gameboard_context(self, name, seat, game, gamestate, now):
+    def gameboard_context(self, name, seat, game, gamestate, now, chat=None):
         response = Box()
-        gameboard_context = game.response(self.response(game, seat), now)
+        gameboard_context = game.response(self.response(game, seat), now, chat=chat)
         gameboard_context.name = name
 
         gamestate = Box(gameboard_context.gamestate)
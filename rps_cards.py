@@ -1,9 +1,13 @@
-from random import choice
+import random
 
-from tipr.models import Game
+from tipr import registry
 from tipr.utils import *
 
 class Restriction(object):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry.register(registry.restrictions, cls)
+
     def __init__(self, arg, source, duration):
         self.arg = arg
         self.source = source
@@ -21,6 +25,10 @@ class Disabled(Restriction):
             return True
 
 class Badge(object):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry.register(registry.badges, cls)
+
     def __init__(self, seat, arg, round):
         self.seat = seat
         self.arg = arg
@@ -77,8 +85,8 @@ class Curse(Badge):
 
     def apply(self, gamestate, delta):
         damage(delta, self.seat, self.arg)
-        total = combine_numeric_modifiers(delta.get(seat).hp)
-        add_message(delta, f"{self.seat}: {self.__class__.__name__}({self.arg}) applies to {seat}. {-total}")
+        total = combine_numeric_modifiers(delta.get(self.seat).hp)
+        add_message(delta, f"{self.seat}: {self.__class__.__name__}({self.arg}) applies to {self.seat}. {-total}")
 
 def generate_curses(type_):
     def apply(self, gamestate, delta):
@@ -92,12 +100,29 @@ def generate_curses(type_):
 [generate_curses(t) for t in TYPELIST]
 
 effect_params = ['gamestate', 'history', 'seat', 'player', 'other', 'timing_bonus', 'level', 'badges_apply', 'delta']
+
+# what an ability sees, made fresh for each RPSCard.apply so games can resolve side by side.
+# rng is the game's source of randomness, see Rules.rng
+class AbilityContext(object):
+    __slots__ = effect_params + ['rng']
+
+    def __init__(self, **params):
+        for name in self.__slots__:
+            setattr(self, name, params.get(name))
+
 class RPSCard(object):
 
     badge_multiplier = 1
     decks = ['basic']
     text = ""
 
+    # cards register themselves, wherever they're defined
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if hasattr(cls, 'ability_order'):
+            RPSCard.init(cls)
+            registry.register_card(cls)
+
     # called on every subclass
     def init(cls):
         # card stages count down; 0 means we're done and won't call apply again
@@ -109,11 +134,11 @@ class RPSCard(object):
 
     @classmethod
     def get_badges(cls, seat, player, type, round):
-        badges = map(lambda name, args, round: next(filter(lambda c: c.__name__ == name, descendants(Badge)))(seat, args, round), *mzip(*player.badges))
+        badges = map(lambda name, args, round: registry.badge(name)(seat, args, round), *mzip(*player.badges))
         return filter(lambda badge: type in badge.types and badge.round < round, badges)  # don't apply badges earned this round
 
     @classmethod
-    def apply(cls, gamestate, history, seat):
+    def apply(cls, gamestate, history, seat, rng=random):
         selection = gamestate.get(seat).selection
         ability_number = selection.ability_number
         timing_bonus = selection.timing
@@ -122,10 +147,12 @@ class RPSCard(object):
         other = gamestate.get(opp(seat))
         delta = update(empty_delta(), Box({seat: {'selection': {'ability_number': ability_number - 1}}}))
         badges_apply = gamestate.meta.outcome.type == 'win' and gamestate.meta.outcome.player == seat
-        globals().update(locals())
-        badge_tuple = cls.abilities[ability_number](cls)
+        ctx = AbilityContext(gamestate=gamestate, history=history, seat=seat, player=player, other=other,
+                             timing_bonus=timing_bonus, level=level, badges_apply=badges_apply, delta=delta, rng=rng)
+        ability = cls.abilities[ability_number]
+        badge_tuple = ability(cls, ctx)
         # one-type abilities can be named after their type instead of returning it
-        badge_types = list(badge_tuple or (cls.abilities[ability_number].__name__,))
+        badge_types = list(badge_tuple or (ability.__name__,))
 
         badges_used = []
         for i in range(cls.badge_multiplier):
@@ -151,30 +178,30 @@ class RPSCard(object):
 
         return delta
 
-    def start(cls):
+    def start(cls, ctx):
         return ('start',)
 
-    def level_up(cls):
-        if badges_apply:
-            card = player.cards[player.selection.slot]
+    def level_up(cls, ctx):
+        if ctx.badges_apply:
+            card = ctx.player.cards[ctx.player.selection.slot]
             card.level += 1
             card.cracked = False
-            update(delta, {seat: {'cards': {'set': (card.slot, card)}}})
-            add_message(delta, f'{seat}: {card.name} levels up')
+            update(ctx.delta, {ctx.seat: {'cards': {'set': (card.slot, card)}}})
+            add_message(ctx.delta, f'{ctx.seat}: {card.name} levels up')
             return ('level_up',)
 
-    def level_damage(cls):
-        if badges_apply:
-            card = other.cards[other.selection.slot]
+    def level_damage(cls, ctx):
+        if ctx.badges_apply:
+            card = ctx.other.cards[ctx.other.selection.slot]
 
             if card.cracked:
                 card.level=max(0, card.level - 1)
                 card.cracked=False
-                add_message(delta, f'{opp(seat)}: {card.name} levels down')
+                add_message(ctx.delta, f'{opp(ctx.seat)}: {card.name} levels down')
             else:
                 card.cracked = True
-                add_message(delta, f'{opp(seat)}: {card.name} cracks')
-            update(delta, {opp(seat): {'cards': {'set': (card.slot, card)}}})
+                add_message(ctx.delta, f'{opp(ctx.seat)}: {card.name} cracks')
+            update(ctx.delta, {opp(ctx.seat): {'cards': {'set': (card.slot, card)}}})
             return ('level_damage',)
 
 
@@ -186,19 +213,19 @@ class Pebble(RPSCard):
     slot = 0
     text = "5 + L damage. T1: gain a 2x damage badge. T2: +3L damage."
 
-    def damage(cls):
-        dmg = 5 + level
-        explanation = f'5 + {level} '
-        if timing_bonus == 2:
-            dmg += 3 * level
-            explanation += f"[2]+ 3[l]({level})[/l][/2] = "
-        damage(delta, opp(seat), dmg)
-        add_message(delta, f"{seat}: Pebble hits! {explanation if explanation else ''}{dmg}")
+    def damage(cls, ctx):
+        dmg = 5 + ctx.level
+        explanation = f'5 + {ctx.level} '
+        if ctx.timing_bonus == 2:
+            dmg += 3 * ctx.level
+            explanation += f"[2]+ 3[l]({ctx.level})[/l][/2] = "
+        damage(ctx.delta, opp(ctx.seat), dmg)
+        add_message(ctx.delta, f"{ctx.seat}: Pebble hits! {explanation if explanation else ''}{dmg}")
 
-    def badge(cls):
-        if timing_bonus >= 1:
-            update(delta, {seat: {'badges': {'dins': ['DmgMultiplier', 2, gamestate.meta.round]}}})
-            add_message(delta, f"{seat}: [1]Pebble grants DmgMultiplier(2x)[/1]")
+    def badge(cls, ctx):
+        if ctx.timing_bonus >= 1:
+            update(ctx.delta, {ctx.seat: {'badges': {'dins': ['DmgMultiplier', 2, ctx.gamestate.meta.round]}}})
+            add_message(ctx.delta, f"{ctx.seat}: [1]Pebble grants DmgMultiplier(2x)[/1]")
 
 
 class Napkin(RPSCard):
@@ -208,22 +235,22 @@ class Napkin(RPSCard):
     slot = 1
     text = "2L health. T1: +4X damage, where X is opposing level. T2: gain a shield."
 
-    def health(cls):
-        amt = -2 * level
-        damage(delta, seat, amt)
-        add_message(delta, f"{seat}: Napkin heals! 2[l]({level})[/l] = {-amt}")
+    def health(cls, ctx):
+        amt = -2 * ctx.level
+        damage(ctx.delta, ctx.seat, amt)
+        add_message(ctx.delta, f"{ctx.seat}: Napkin heals! 2[l]({ctx.level})[/l] = {-amt}")
 
-    def damage(cls):
-        other_ability = other.selection.slot
-        other_level = other.cards[other_ability].level
+    def damage(cls, ctx):
+        other_ability = ctx.other.selection.slot
+        other_level = ctx.other.cards[other_ability].level
         total = 4 * other_level
-        damage(delta, opp(seat), total)
-        add_message(delta, f"{seat}: [1]Napkin hits! 4[o]({other_level})[/o] = {total}[/1]")
+        damage(ctx.delta, opp(ctx.seat), total)
+        add_message(ctx.delta, f"{ctx.seat}: [1]Napkin hits! 4[o]({other_level})[/o] = {total}[/1]")
 
-    def shield(cls):
-        if timing_bonus == 2:
-            shields(delta, seat, 1)
-            add_message(delta, f"{seat}: [2]Napkin grants a shield[/2]")
+    def shield(cls, ctx):
+        if ctx.timing_bonus == 2:
+            shields(ctx.delta, ctx.seat, 1)
+            add_message(ctx.delta, f"{ctx.seat}: [2]Napkin grants a shield[/2]")
 
 
 class ButterKnife(RPSCard):
@@ -233,31 +260,31 @@ class ButterKnife(RPSCard):
     slot = 2
     text = "10 + 2L damage. disable opposing ability for 1 turn. T1: disable another random opposing ability for one turn. T2: +10 + 2L damage."
 
-    def damage(cls):
-        dmg = 10 + 2 * level
-        explanation = f" 10 + 2[l]({level})[/l]"
-        if timing_bonus >= 2:
+    def damage(cls, ctx):
+        dmg = 10 + 2 * ctx.level
+        explanation = f" 10 + 2[l]({ctx.level})[/l]"
+        if ctx.timing_bonus >= 2:
             dmg += 10
-            dmg += 2 * level
-            explanation += f" [2]+ 10 + 2[l]({level})[/l][/2]"
-        damage(delta, opp(seat), dmg)
-        add_message(delta, f"{seat}: ButterKnife hits! {explanation} = {dmg}")
-
-    def disable(cls):
-        abilities_to_disable = [other.selection.slot]
-        if timing_bonus >= 1:
+            dmg += 2 * ctx.level
+            explanation += f" [2]+ 10 + 2[l]({ctx.level})[/l][/2]"
+        damage(ctx.delta, opp(ctx.seat), dmg)
+        add_message(ctx.delta, f"{ctx.seat}: ButterKnife hits! {explanation} = {dmg}")
+
+    def disable(cls, ctx):
+        abilities_to_disable = [ctx.other.selection.slot]
+        if ctx.timing_bonus >= 1:
             other_slots = set(range(9))
-            other_slots.remove(other.selection.slot)
-            abilities_to_disable.append(choice(list(other_slots)))
+            other_slots.remove(ctx.other.selection.slot)
+            abilities_to_disable.append(ctx.rng.choice(list(other_slots)))
         for i, opposing_ability in enumerate(abilities_to_disable):
             if opposing_ability not in [TRUCE, INCOME]:
-                source = f"{seat}'s ButterKnife @ round {gamestate.meta.round}"
+                source = f"{ctx.seat}'s ButterKnife @ round {ctx.gamestate.meta.round}"
                 rest = Disabled(opposing_ability, source, 1)
-                update(delta, {opp(seat): {'restrictions': {'dins': rest.json()}}})
-                opposing_name = other.cards[opposing_ability].name
-                add_message(delta, f"{seat}: {'[1]' if i else ''}ButterKnife disables {opposing_name} for 1 round!{'[/1]' if i else ''}")
+                update(ctx.delta, {opp(ctx.seat): {'restrictions': {'dins': rest.json()}}})
+                opposing_name = ctx.other.cards[opposing_ability].name
+                add_message(ctx.delta, f"{ctx.seat}: {'[1]' if i else ''}ButterKnife disables {opposing_name} for 1 round!{'[/1]' if i else ''}")
             else:
-                add_message(delta, f"{seat}: ButterKnife can't disable nothing!")
+                add_message(ctx.delta, f"{ctx.seat}: ButterKnife can't disable nothing!")
 
 
 class Boulder(RPSCard):
@@ -267,14 +294,14 @@ class Boulder(RPSCard):
     slot = 3
     text = "gain a +25+5L damage badge. T1: gain a +2 level badge."
 
-    def badge(cls):
-        total = 25 + 5 * level
-        explanation = f"25 + 5[l]({level})[/l]"
-        update(delta, {seat: {'badges': {'dins': ['DmgBonus', total, gamestate.meta.round]}}})
-        add_message(delta, f"{seat}: Boulder grants DmgBonus! {explanation} = {total}")
-        if timing_bonus >= 1:
-            update(delta, {seat: {'badges': {'dins': ['LvlBonus', 2, gamestate.meta.round]}}})
-            add_message(delta, f"{seat}: [1]Boulder grants LvlBonus(2)![/1]")
+    def badge(cls, ctx):
+        total = 25 + 5 * ctx.level
+        explanation = f"25 + 5[l]({ctx.level})[/l]"
+        update(ctx.delta, {ctx.seat: {'badges': {'dins': ['DmgBonus', total, ctx.gamestate.meta.round]}}})
+        add_message(ctx.delta, f"{ctx.seat}: Boulder grants DmgBonus! {explanation} = {total}")
+        if ctx.timing_bonus >= 1:
+            update(ctx.delta, {ctx.seat: {'badges': {'dins': ['LvlBonus', 2, ctx.gamestate.meta.round]}}})
+            add_message(ctx.delta, f"{ctx.seat}: [1]Boulder grants LvlBonus(2)![/1]")
 
 
 class Book(RPSCard):
@@ -284,45 +311,45 @@ class Book(RPSCard):
     slot = 4
     text = "1+7X damage, where X is the total level of all abilities that share a type with this one. then this ability’s type becomes the type of the ability you selected last turn, or paper if there is no such type. the ability you selected last turn levels up. T1: the ability you selected last turn levels up two more times."
 
-    def damage(cls):
+    def damage(cls, ctx):
         def type_levels(type, p):
             return [card.level for card in p.cards if card.type == type]
-        book_type = player.cards[4].type
-        ours = type_levels(book_type, player)
-        theirs = type_levels(book_type, other)
+        book_type = ctx.player.cards[4].type
+        ours = type_levels(book_type, ctx.player)
+        theirs = type_levels(book_type, ctx.other)
         total = 1 + 7 * (sum(ours) + sum(theirs))
-        damage(delta, opp(seat), total)
-        add_message(delta, f"{seat}: Book ({TYPES[book_type]}) hits! 1 + 7([l]{ours}[/l] + [L]{theirs}[/L]) = {total}")
+        damage(ctx.delta, opp(ctx.seat), total)
+        add_message(ctx.delta, f"{ctx.seat}: Book ({TYPES[book_type]}) hits! 1 + 7([l]{ours}[/l] + [L]{theirs}[/L]) = {total}")
 
-    def respec(cls):
-        prev_frame = Game.intermediate_states(history, -2, last_only=True)
-        card = player.cards[4]
-        if not prev_frame or player.cards[prev_frame.info[seat].selection.slot].type == -1:
+    def respec(cls, ctx):
+        prev_frame = intermediate_states(ctx.history, -2, last_only=True)
+        card = ctx.player.cards[4]
+        if not prev_frame or ctx.player.cards[prev_frame.info[ctx.seat].selection.slot].type == -1:
             card.type = PAPER
-            add_message(delta, f"{seat}: Book reverts to paper, since no type was chosen last turn.")
+            add_message(ctx.delta, f"{ctx.seat}: Book reverts to paper, since no type was chosen last turn.")
         else:
-            prev_card = player.cards[prev_frame.info[seat].selection.slot]
+            prev_card = ctx.player.cards[prev_frame.info[ctx.seat].selection.slot]
             prev_type = prev_card.type
             card.type = prev_type
-            add_message(delta, f"{seat}: Book becomes {TYPES[prev_type]}, because {prev_card.name} was chosen last turn.")
-        update(delta, {seat: {'cards': {'set': (4, card)}}})
+            add_message(ctx.delta, f"{ctx.seat}: Book becomes {TYPES[prev_type]}, because {prev_card.name} was chosen last turn.")
+        update(ctx.delta, {ctx.seat: {'cards': {'set': (4, card)}}})
 
-    def level(cls):
-        prev_frame = Game.intermediate_states(history, -2, last_only=True)
-        if not prev_frame or player.cards[prev_frame.info[seat].selection.slot].type == -1:
-            add_message(delta, f"{seat}: [1]Can't level up nothing![/1]")
+    def level(cls, ctx):
+        prev_frame = intermediate_states(ctx.history, -2, last_only=True)
+        if not prev_frame or ctx.player.cards[prev_frame.info[ctx.seat].selection.slot].type == -1:
+            add_message(ctx.delta, f"{ctx.seat}: [1]Can't level up nothing![/1]")
             return
-        prev_slot = prev_frame.info[seat].selection.slot
-        card = player.cards[prev_slot]
+        prev_slot = prev_frame.info[ctx.seat].selection.slot
+        card = ctx.player.cards[prev_slot]
         card.cracked = False
         card.level += 1
         timing = ''
-        if timing_bonus >= 1:
+        if ctx.timing_bonus >= 1:
             card.level += 2
             timing = " [1]three times[/1]"
-        update(delta, {seat: {'cards': {'set': (prev_slot, card)}}})
+        update(ctx.delta, {ctx.seat: {'cards': {'set': (prev_slot, card)}}})
 
-        add_message(delta, f"{seat}: {card.name} levels up{timing}! (Book)")
+        add_message(ctx.delta, f"{ctx.seat}: {card.name} levels up{timing}! (Book)")
 
 class Wirecutter(RPSCard):
 
@@ -331,22 +358,22 @@ class Wirecutter(RPSCard):
     slot = 5
     text = "X damage, where X is the sum of levels of all your scissors abilities. gain a badge with “if this is a scissors ability, 3x damage.” T1: a random non-scissors ability of yours becomes scissors"
 
-    def damage(cls):
-        levels = [card.level for card in player.cards if card.type == SCISSORS]
+    def damage(cls, ctx):
+        levels = [card.level for card in ctx.player.cards if card.type == SCISSORS]
         total = sum(levels)
-        damage(delta, opp(seat), total)
-        add_message(delta, f"{seat}: Wirecutter hits! [l]{levels}[/l] = {total}")
+        damage(ctx.delta, opp(ctx.seat), total)
+        add_message(ctx.delta, f"{ctx.seat}: Wirecutter hits! [l]{levels}[/l] = {total}")
 
-    def badge(cls):
-        update(delta, {seat: {'badges': {'dins': ['ScissorsDmgMultiplier', 3, gamestate.meta.round]}}})
-        add_message(delta, f"{seat}: [1]Wirecutter grants ScissorsDmgMultiplier(3)![/1]")
+    def badge(cls, ctx):
+        update(ctx.delta, {ctx.seat: {'badges': {'dins': ['ScissorsDmgMultiplier', 3, ctx.gamestate.meta.round]}}})
+        add_message(ctx.delta, f"{ctx.seat}: [1]Wirecutter grants ScissorsDmgMultiplier(3)![/1]")
 
-    def respec(cls):
-        if timing_bonus >= 1:
-            card = choice(player.cards)
+    def respec(cls, ctx):
+        if ctx.timing_bonus >= 1:
+            card = ctx.rng.choice(ctx.player.cards)
             card.type = SCISSORS
-            update(delta, {seat: {'cards': {'set': (card.slot, card)}}})
-            add_message(delta, f"{seat}: {card.name} becomes scissors")
+            update(ctx.delta, {ctx.seat: {'cards': {'set': (card.slot, card)}}})
+            add_message(ctx.delta, f"{ctx.seat}: {card.name} becomes scissors")
 
 class Mountain(RPSCard):
 
@@ -356,17 +383,17 @@ class Mountain(RPSCard):
     badge_multiplier = 2
     text = "15 + 10L damage. crack all opposing abilities. badges apply twice."
 
-    def damage(cls):
-        total = 15 + 10 * level
-        damage(delta, opp(seat), total)
-        add_message(delta, f"{seat}: Mountain hits! 15 + [l]{level} * 10[/l] = {total}")
+    def damage(cls, ctx):
+        total = 15 + 10 * ctx.level
+        damage(ctx.delta, opp(ctx.seat), total)
+        add_message(ctx.delta, f"{ctx.seat}: Mountain hits! 15 + [l]{ctx.level} * 10[/l] = {total}")
 
-    def crack(cls):
-        cracked_names = list(map(lambda card: card['name'], filter(lambda card: not card.cracked and not card.type == DEFAULT, other.cards)))
-        for card in other.cards:
+    def crack(cls, ctx):
+        cracked_names = list(map(lambda card: card['name'], filter(lambda card: not card.cracked and not card.type == DEFAULT, ctx.other.cards)))
+        for card in ctx.other.cards:
             card.cracked = True
-            update(delta, {opp(seat): {'cards': other.cards}})
-        add_message(delta, f"{seat}: Mountain cracks all uncracked {opp(seat)} cards! ({cracked_names})")
+            update(ctx.delta, {opp(ctx.seat): {'cards': ctx.other.cards}})
+        add_message(ctx.delta, f"{ctx.seat}: Mountain cracks all uncracked {opp(ctx.seat)} cards! ({cracked_names})")
 
 class Contract(RPSCard):
 
@@ -375,25 +402,25 @@ class Contract(RPSCard):
     slot = 7
     text = "7 damage. gain a shield. your opponent gains an end badge with “if this is a TYPE ability, you take 20 + 10L damage”, where TYPE is the opposing type."
 
-    def damage(cls):
+    def damage(cls, ctx):
         dmg = 7
-        damage(delta, opp(seat), dmg)
-        add_message(delta, f"{seat}: Contract hits! 7")
+        damage(ctx.delta, opp(ctx.seat), dmg)
+        add_message(ctx.delta, f"{ctx.seat}: Contract hits! 7")
 
-    def shield(cls):
-        shields(delta, seat, 1)
-        add_message(delta, f"{seat}: Contract grants a shield")
+    def shield(cls, ctx):
+        shields(ctx.delta, ctx.seat, 1)
+        add_message(ctx.delta, f"{ctx.seat}: Contract grants a shield")
 
-    def badge(cls):
-        other_type = other.cards[other.selection.slot].type
+    def badge(cls, ctx):
+        other_type = ctx.other.cards[ctx.other.selection.slot].type
         if other_type < 0:
-            add_message(delta, f"{seat}: Can't make a Contract with nothing!")
+            add_message(ctx.delta, f"{ctx.seat}: Can't make a Contract with nothing!")
             return
         typename = TYPES[other_type]
-        bonus = 10 * level
+        bonus = 10 * ctx.level
         total = 20 + bonus
-        update(delta, {opp(seat): {'badges': {'dins': [f'{typename}Curse', total, gamestate.meta.round]}}})
-        add_message(delta, f"{seat}: Contract grants {opp(seat)} {typename}Curse(20 + {bonus} = {total})")
+        update(ctx.delta, {opp(ctx.seat): {'badges': {'dins': [f'{typename}Curse', total, ctx.gamestate.meta.round]}}})
+        add_message(ctx.delta, f"{ctx.seat}: Contract grants {opp(ctx.seat)} {typename}Curse(20 + {bonus} = {total})")
 
 class TwoHander(RPSCard):
 
@@ -402,23 +429,23 @@ class TwoHander(RPSCard):
     slot = 8
     text = "5 damage if level 0, otherwise 50 damage. if opposing ability is cracked, disable all opposing abilities for one turn and disable this for three turns."
 
-    def damage(cls):
-        dmg = 5 if level == 0 else 50
-        damage(delta, opp(seat), dmg)
+    def damage(cls, ctx):
+        dmg = 5 if ctx.level == 0 else 50
+        damage(ctx.delta, opp(ctx.seat), dmg)
         #add_message(delta, f"{seat}: TwoHander hits! 8[l]({level})[/l] = {dmg}")
-        add_message(delta, f"{seat}: TwoHander hits! {dmg}")
+        add_message(ctx.delta, f"{ctx.seat}: TwoHander hits! {dmg}")
 
-    def disable(cls):
-        if other.cards[other.selection.slot].cracked:
-            source = f"{seat}'s TwoHander @ round {gamestate.meta.round}"
+    def disable(cls, ctx):
+        if ctx.other.cards[ctx.other.selection.slot].cracked:
+            source = f"{ctx.seat}'s TwoHander @ round {ctx.gamestate.meta.round}"
             for i in range(9):
                 rest = Disabled(i, source, 1)
-                update(delta, {opp(seat): {'restrictions': {'dins': rest.json()}}})
+                update(ctx.delta, {opp(ctx.seat): {'restrictions': {'dins': rest.json()}}})
             rest = Disabled(8, source, 3)
-            update(delta, {seat: {'restrictions': {'dins': rest.json()}}})
-            add_message(delta, f"{seat}: TwoHander disables everything for 1 round! TwoHander is disabled for 3 rounds.")
+            update(ctx.delta, {ctx.seat: {'restrictions': {'dins': rest.json()}}})
+            add_message(ctx.delta, f"{ctx.seat}: TwoHander disables everything for 1 round! TwoHander is disabled for 3 rounds.")
         else:
-            add_message(delta, f"{seat}: TwoHander does not sense weakness!")
+            add_message(ctx.delta, f"{ctx.seat}: TwoHander does not sense weakness!")
 
 
 class Truce(RPSCard):
@@ -427,8 +454,8 @@ class Truce(RPSCard):
     ability_order = ['loss']
     slot = 9
 
-    def loss(cls):
-        damage(delta, seat, 1)
+    def loss(cls, ctx):
+        damage(ctx.delta, ctx.seat, 1)
 
 
 class PaciveIncome(RPSCard):
@@ -437,8 +464,5 @@ class PaciveIncome(RPSCard):
     ability_order = ['health']
     slot = 10
 
-    def health(cls):
-        damage(delta, seat, -2)
-
-for cls in RPSCard.__subclasses__():
-    RPSCard.init(cls)
+    def health(cls, ctx):
+        damage(ctx.delta, ctx.seat, -2)
@@ -1,27 +1,72 @@
-from django.template.loader import render_to_string 
 from tipr.utils import *
-from django.core.cache import cache
-import logging
+from tipr.render_cache import render_cache
 
 class Rules(object):
     def winner(self, game):
         pass
 
+    # randomness for the game's next update, see utils.game_rng
+    def rng(self, game):
+        return game_rng(game.options, game.gamestate)
 
-    def render_gameboard(self, name, load, seat, game, gamestate, now):
-        gameboard_context = self.gameboard_context(name, seat, game, gamestate, now)
+    # whether the timer is running
+    def timed(self, game, gamestate):
+        return True
+
+    # when the next update is due, as a timestamp, or None if the game is waiting on moves
+    def deadline(self, game, gamestate):
+        if game.status != ACTIVE:
+            return None
+        now = tznow()
+        # the clock hasn't started yet, which the next update takes care of
+        if game.last_tick is None or game.next_tick is None or self.should_update(game, gamestate, now):
+            return now.timestamp()
+        if not self.timed(game, gamestate) or game.next_tick < 0:
+            return None
+        return game.last_tick.timestamp() + game.next_tick
+
+
+    # boards are shared by everyone in the same seat role at the same version, so
+    # every spectator gets the same render. the timer changes by the second and isn't cached.
+    # chat_cursor: the last chat message the client has. with one, only newer lines come back
+    # as chat_lines for the client to append; without, the whole recent chat window is rendered.
+    def render_gameboard(self, name, load, seat, game, gamestate, now, chat_cursor=None):
+        role = ('p1', 'p2', 'spectator')[seat]
+        gameboard_context = None
+        chat_rows = None
+
+        # read once, for whichever of the board and the chat isn't cached
+        def messages():
+            nonlocal chat_rows
+            if chat_rows is None:
+                chat_rows = game.chat_since(chat_cursor)
+            return chat_rows
+
+        def context():
+            nonlocal gameboard_context
+            if gameboard_context is None:
+                gameboard_context = self.gameboard_context(name, seat, game, gamestate, now, messages())
+            return gameboard_context
+
+        # imported here so the rules can be used without Django (see sim.py)
+        from django.template.loader import render_to_string
         response = Box()
-        response.gameboard = render_to_string(f'{game.type}_board.html', gameboard_context)
-        response.timer = render_to_string('timer.html', gameboard_context)
-        response.chat = render_to_string( 'chat.html', {'chat_log': game.chat_log})
-        name = gameboard_context.name
-        if not load and response.gameboard == cache.get(f'{name}_gameboard'):
-            logging.warning('u')
-            response.gameboard = 'U'
+        response.gameboard = render_cache.get_or_render(
+            ('board', game.pk, role, game.version),
+            lambda: render_to_string(f'{game.type}_board.html', context()))
+        duration, remaining = game.timer(game.status, game.last_tick, game.next_tick, now)
+        response.timer = render_to_string('timer.html', {'time_remaining': remaining, 'timer_duration': duration})
+
+        def chat(template):
+            rows = messages()
+            cursor = rows[-1].pk if rows else chat_cursor or 0
+            return render_to_string(template, {'chat_log': [message.line() for message in rows]}), cursor
+
+        if chat_cursor is None:
+            response.chat, response.chat_cursor = render_cache.get_or_render(
+                ('chat', game.pk, game.version), lambda: chat('chat.html'))
         else:
-            cache.set(f'{name}_gameboard', response.gameboard)
-        if not load and response.chat == cache.get(f'{name}_chat'):
             response.chat = 'U'
-        else:
-            cache.set(f'{name}_chat', response.chat)
+            response.chat_lines, response.chat_cursor = render_cache.get_or_render(
+                ('chat', game.pk, game.version, chat_cursor), lambda: chat('chat_lines.html'))
         return response
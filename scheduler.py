@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from tipr.utils import *
+
+# don't spin on a game whose deadline has come but whose rules don't agree yet
+MIN_WAIT = .01
+# a game whose tick failed is tried again after RETRY_FIRST seconds, doubling up to RETRY_MAX
+RETRY_FIRST = .5
+RETRY_MAX = 30
+
+
+def game_group(id):
+    return f'game_{id}'
+
+
+# Server-side ticks for timed games. Keeps a heap of (deadline, game id) and advances each
+# game when it's due instead of waiting for someone to poll. Runs as an asyncio task in the
+# ASGI process; enable with TIPR_TICK_SCHEDULER = True in settings.
+# With TIPR_COMPACT_FINISHED = True it also compacts games it sees finish, see Game.compact.
+class TickScheduler(object):
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}  # game id -> live deadline. anything else in the heap is stale
+        self.failures = {}  # game id -> ticks in a row that raised
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'TIPR_TICK_SCHEDULER', False)
+
+    # whether ticks are happening here. enabled() only says they should once something starts
+    # the task, which WSGI and manage.py processes never do
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        if self.task is None and self.enabled():
+            self.task = asyncio.ensure_future(self.run())
+
+    # ASGI wrapper that starts the scheduler on the first connection
+    def middleware(self, app):
+        async def application(scope, receive, send):
+            self.start()
+            return await app(scope, receive, send)
+        return application
+
+    # something happened to a game outside the scheduler (a move, a sit, a rewind):
+    # look at it again once the transaction commits. safe to call from any thread.
+    def poke(self, id):
+        if self.loop is None:
+            return
+        transaction.on_commit(lambda: self.loop.call_soon_threadsafe(self.push, id, time.time()))
+
+    def push(self, id, deadline):
+        if deadline is None:
+            self.deadlines.pop(id, None)
+            return
+        self.deadlines[id] = deadline
+        heapq.heappush(self.heap, (deadline, id))
+        self.wakeup.set()
+
+    def pop_due(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            deadline, id = heapq.heappop(self.heap)
+            if self.deadlines.get(id) == deadline:
+                del self.deadlines[id]
+                return id
+
+    async def run(self):
+        from tipr.hotstore import FLUSH_EVERY, hot_store
+        from tipr.models import Game
+        from tipr.views import Update
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        for id in await database_sync_to_async(active_games)():
+            self.push(id, time.time())
+        while True:
+            while (id := self.pop_due(time.time())) is not None:
+                try:
+                    changed, deadline = await database_sync_to_async(Update.advance_by_id)(id)
+                except Exception:
+                    logging.exception(f'scheduled tick failed for game {id}')
+                    # e.g. Game.Conflict after every retry. nothing else would bring it back
+                    failures = self.failures[id] = self.failures.get(id, 0) + 1
+                    if id not in self.deadlines:
+                        self.push(id, time.time() + min(RETRY_FIRST * 2 ** (failures - 1), RETRY_MAX))
+                    continue
+                self.failures.pop(id, None)
+                if changed:
+                    await notify(id)
+                if deadline is None and getattr(settings, 'TIPR_COMPACT_FINISHED', False):
+                    try:
+                        await database_sync_to_async(Game.compact_by_id)(id)
+                    except Exception:
+                        logging.exception(f'compacting game {id} failed')
+                if deadline is not None and id not in self.deadlines:
+                    self.push(id, max(deadline, time.time() + MIN_WAIT))
+            if hot_store.enabled():
+                try:
+                    await database_sync_to_async(hot_store.flush_stale)()
+                except Exception:
+                    logging.exception('writing held game state failed')
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if hot_store.enabled():
+                timeout = FLUSH_EVERY if timeout is None else min(timeout, FLUSH_EVERY)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def active_games():
+    from tipr.models import Game
+    return list(Game.objects.filter(status=ACTIVE).values_list('pk', flat=True))
+
+
+# tell connected clients to fetch the new state
+async def notify(id):
+    if layer := get_channel_layer():
+        await layer.group_send(game_group(id), {'type': 'game.update', 'game': id})
+
+
+# same, from synchronous view code, once the current transaction commits
+def announce(id):
+    if get_channel_layer():
+        transaction.on_commit(lambda: async_to_sync(notify)(id))
+
+
+ticker = TickScheduler()
@@ -0,0 +1,322 @@
+# headless games: the rules driven in-process, with no Django and no database.
+# mirrors Submit.post / Update.advance closely enough that a sim game and a real one
+# go through the same states, but every tick is due immediately.
+#
+#   python -m tipr.sim --type rps --games 1000 --seed 1
+#
+# the sim reads plain state through tracked.py and applies deltas to it, so the only Box of a
+# state is the one the rps rules make to work in: stage 4 abilities change the state they're
+# given as they go. on one core that's about 120 rps games a minute (18 rounds, ~150 ticks
+# each), half of it that Box, and 3400 liar games. balance.py runs games over a process pool,
+# so it gets that per core.
+import argparse
+import concurrent.futures
+import copy
+import json
+import logging
+import random
+import time
+
+from tipr.utils import *
+from tipr.tracked import track
+from tipr.rps import RPSRules
+from tipr.liar import LiarRules, ROUND_STRUCTURE
+
+rules_classes = {
+    'rps': RPSRules(),
+    'liar': LiarRules(),
+}
+
+# what a JSONField round trip does to a value: Boxes become dicts, tuples become lists
+def normalise(value):
+    return json.loads(json.dumps(value))
+
+
+# stands in for models.Game. history is the legacy list form, [[<keyframe>, <event>, ..], ..],
+# which utils.intermediate_states understands.
+class SimGame(object):
+    def __init__(self, type, options, gamestate, people=('p1', 'p2')):
+        self.pk = None
+        self.type = type
+        self.options = options
+        self.store(gamestate)
+        self.people = [list(people), [True] * len(people)]
+        self.status = ACTIVE
+        self.history = []
+        self.last_tick = None
+        self.next_tick = None
+        self.clock = 0.0
+
+    # what a JSONField holds
+    def store(self, gamestate):
+        self.gamestate = normalise(gamestate)
+        self._view = None
+
+    # the gamestate for the sim and the policies to read, Box-style (tracked.py). a Box of a whole
+    # gamestate costs several times the JSON round trip that normalises it, and only the rules
+    # need one
+    def view(self):
+        if self._view is None:
+            self._view = track(self.gamestate)
+        return self._view
+
+    # the simulator only asks when it wants to tick
+    def has_ticked(self, timestamp):
+        return True
+
+    def keyframe(self):
+        self.history.append([{'type': 'keyframe', 'info': copy.deepcopy(self.gamestate), 'timestamp': self.clock}])
+
+    def event(self, type, info):
+        self.history[-1].append({'type': type, 'info': normalise(info), 'timestamp': self.clock})
+
+
+class Simulation(object):
+
+    # policies: one callable per seat, policy(game, seat, rng) -> move or None
+    def __init__(self, type='rps', policies=None, options=None, seed=None, max_steps=10000, observer=None):
+        self.type = type
+        self.rules = rules_classes[type]
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.policies = policies or (random_policies[type],) * 2
+        self.options = options or {}
+        self.max_steps = max_steps
+        self.observer = observer
+        self.steps = 0
+        self.messages = []
+        self.error = None
+        self.game = None
+
+    def setup(self):
+        # the rules roll from the game's own seed (utils.game_rng), so the policies can't change what they roll
+        options = update(self.rules.DEFAULT_OPTIONS.copy(), self.options)
+        if 'seed' not in options:
+            options['seed'] = self.seed if self.seed is not None else random.getrandbits(48)
+        if 'deck' not in options:
+            options['deck'] = RPSRules.deck(game_rng(options, salt='deck'))
+        self.game = SimGame(self.type, options, self.rules.start_state(options))
+        self.game.keyframe()
+        self.game.last_tick = self.game.clock
+        self.game.next_tick = self.rules.next_tick(self.game)
+        return self.game
+
+    def run(self):
+        game = self.game or self.setup()
+        while game.status == ACTIVE and not self.error:
+            if self.steps >= self.max_steps:
+                self.error = f'gave up after {self.steps} steps'
+                break
+            for seat, policy in enumerate(self.policies):
+                move = policy(game, seat, self.rng)
+                if move is not None:
+                    self.move(seat, move)
+            if not self.advance():
+                self.error = 'stalled: no moves and nothing due'
+        return self.result()
+
+    def move(self, seat, move):
+        delta = self.rules.move(self.game, seat, move)
+        if 'error' in delta:
+            return delta
+        self.game.event('move', {'seat': seat, 'move': move})
+        self.game.store(update(self.game.gamestate, delta))
+        if self.observer:
+            self.observer('move', self, seat, move)
+        return delta
+
+    # tick until the players have something to do. returns False if nothing was due.
+    def advance(self):
+        ticked = False
+        while self.game.status == ACTIVE and self.steps < self.max_steps:
+            if not self.rules.should_update(self.game, self.game.view(), self.game.clock):
+                break
+            self.tick()
+            ticked = True
+            if self.error or self.awaiting_moves():
+                break
+        return ticked
+
+    # same shape as Update.advance
+    def tick(self):
+        game, rules = self.game, self.rules
+        self.steps += 1
+        game.clock += max(game.next_tick or 0, 0)
+        keyframe_name = rules.keyframe_name
+        prev = game.gamestate['meta'][keyframe_name]
+        try:
+            delta = rules.do_update(game)
+            gamestate = update(game.gamestate, delta)
+        except Exception as e:
+            logging.exception('sim tick')
+            self.error = f'error doing timed update: {e!r}'
+            return
+        self.messages.extend(gamestate['meta']['message'])
+        gamestate['meta']['message'] = []
+        game.store(gamestate)
+        gamestate = game.view()
+
+        if gamestate.meta[keyframe_name] != prev:
+            if winner := rules.winner(gamestate):
+                self.messages.append(winner)
+                game.status = FINISHED
+            game.keyframe()
+        else:
+            game.event('time', delta)
+        game.last_tick = game.clock
+        game.next_tick = rules.next_tick(game)
+        if self.observer:
+            self.observer('tick', self, delta)
+
+    # whether a tick right now would skip a decision. rps stage 4 and liar's START need nobody.
+    def awaiting_moves(self):
+        meta = self.game.gamestate['meta']
+        if self.type == 'rps':
+            return meta['stage'] < 4 and bool(self.game.options.get('timed'))
+        return ROUND_STRUCTURE[meta['round']] not in ('START', 'DONE')
+
+    def result(self):
+        gamestate = self.game.view()
+        text = self.rules.winner(gamestate) if self.game.status == FINISHED else None
+        return Box(seed=self.seed, type=self.type, winner=winning_seat(text), text=text,
+                   rounds=gamestate.meta.round, steps=self.steps, error=self.error,
+                   gamestate=self.game.gamestate)
+
+
+# 'p1 wins!', '3 - 1: p1 wins!', 'p1' (both dead) -> 'p1'. ties and unfinished games are None
+def winning_seat(text):
+    if not text:
+        return None
+    for seat in seats:
+        if text == seat or text.endswith(f'{seat} wins!'):
+            return seat
+    return None
+
+
+# game's gamestate to read Box-style: the sim game's own view, or a Box for a real game (loadtest.py)
+def view(game):
+    return game.view() if isinstance(game, SimGame) else Box(game.gamestate)
+
+def rps_random(game, seat, rng):
+    gamestate = view(game)
+    player = gamestate[seats[seat]]
+    stage = gamestate.meta.stage
+    if stage > 3 or any(player.stages.values()):
+        return None
+    rules = rules_classes['rps']
+    slots = [slot for slot in range(9) if not game.options.get('timed') or slot // 3 <= stage - 1]
+    rng.shuffle(slots)
+    for slot in slots + [-1]:
+        move = {'type': 'selection', 'selection': slot}
+        if not any(r.applies(gamestate, seats[seat], Box(move)) for r in rules.get_restrictions(gamestate, seats[seat])):
+            if slot == -1 or rng.random() > .02:
+                return move
+    return None
+
+def liar_random(game, seat, rng):
+    gamestate = view(game)
+    player = gamestate[seats[seat]]
+    if player.submission is not None:
+        return None
+    round = gamestate.meta.round
+    match ROUND_STRUCTURE[round]:
+        case 'WRITE':
+            return f"the sum is at least {rng.randint(10, 80)} ({len(gamestate.statements)})"
+        case 'CLARIFY':
+            return [] if rng.random() > .05 else [str(len(gamestate.statements) - 2 + seat)]
+        case 'BET':
+            bets = {}
+            for id in range(len(gamestate.statements)):
+                cap = id // 2 + 1 + (1 if round == 11 else 0)
+                bets[str(id)] = {rng.choice(['true', 'false']): rng.randint(0, cap)}
+            return bets
+        case 'REVEAL':
+            return rng.choice(player.hand) if rng.random() > .1 else rng.randint(1, 9)
+        case 'ADJUDICATE':
+            # both seats have to agree, so decide from the statement text
+            return [str(i) for i, statement in enumerate(gamestate.statements)
+                    if random.Random(statement.text).random() < .5]
+    return None
+
+random_policies = {
+    'rps': rps_random,
+    'liar': liar_random,
+}
+
+# plays the given moves in order, one per call where the random policy would move, then passes
+def scripted(moves, fallback=None):
+    moves = list(moves)
+    def policy(game, seat, rng):
+        if (random_policies[game.type])(game, seat, rng) is None:
+            return None
+        if moves:
+            return moves.pop(0)
+        return fallback(game, seat, rng) if fallback else None
+    return policy
+
+
+# rebuild a game from its options (seed, deck) and its moves, [[interval, seq, seat, move], ..]:
+# each move goes back where it was in history, and every other position in history was an update.
+def replay(type, options, moves, max_steps=10000):
+    sim = Simulation(type, policies=(), options=copy.deepcopy(options), max_steps=max_steps)
+    game = sim.setup()
+    moves = sorted(moves, key=lambda move: move[:2])
+    i = 0
+    while game.status == ACTIVE and not sim.error:
+        if sim.steps >= max_steps:
+            sim.error = f'gave up after {sim.steps} steps'
+        elif i < len(moves) and list(moves[i][:2]) == [len(game.history) - 1, len(game.history[-1])]:
+            if 'error' in (delta := sim.move(moves[i][2], moves[i][3])):
+                sim.error = f'move {moves[i]} rejected: {delta["error"]}'
+            i += 1
+        else:
+            sim.tick()
+    if i < len(moves) and not sim.error:
+        sim.error = f'{len(moves) - i} moves after the end of the game'
+    return sim
+
+def simulate(type='rps', games=100, seed=0, options=None, max_steps=10000):
+    return [Simulation(type, options=options, seed=seed + n, max_steps=max_steps).run() for n in range(games)]
+
+# plays the same seeds serially and then across threads, returning the seeds whose games came
+# out differently. anything the rules keep outside the game being resolved shows up here.
+def stress(type='rps', games=32, threads=8, seed=0, options=None):
+    def play(n):
+        return normalise(Simulation(type, options=options, seed=seed + n).run())
+    serial = [play(n) for n in range(games)]
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        threaded = list(pool.map(play, range(games)))
+    return [seed + n for n in range(games) if serial[n] != threaded[n]]
+
+def summarise(results):
+    summary = Box(games=len(results), p1=0, p2=0, tie=0, errors=0)
+    for result in results:
+        if result.error:
+            summary.errors += 1
+        else:
+            summary[result.winner or 'tie'] += 1
+    summary.mean_rounds = sum(r.rounds for r in results) / max(len(results), 1)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='play games headlessly')
+    parser.add_argument('--type', default='rps', choices=sorted(rules_classes))
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timed', action='store_true')
+    parser.add_argument('--fast', action='store_true', help='rps fast_resolve')
+    parser.add_argument('--max-steps', type=int, default=10000)
+    parser.add_argument('--stress', type=int, metavar='THREADS', help='check threaded games match serial ones')
+    args = parser.parse_args()
+    # the rules log at warning level
+    logging.disable(logging.WARNING)
+    if args.stress:
+        mismatched = stress(args.type, args.games, args.stress, args.seed, {'timed': args.timed, 'fast_resolve': args.fast})
+        print(f'{len(mismatched)} of {args.games} games differed' + (f': seeds {mismatched}' if mismatched else ''))
+        raise SystemExit(1 if mismatched else 0)
+    start = time.perf_counter()
+    results = simulate(args.type, args.games, args.seed, {'timed': args.timed, 'fast_resolve': args.fast}, args.max_steps)
+    elapsed = time.perf_counter() - start
+    print(json.dumps(summarise(results)))
+    print(f'{len(results) / elapsed:.1f} games/s')
@@ -0,0 +1,124 @@
+# checks behind the command line tools, small enough to run with everything else, and of the
+# websocket consumer:
+#
+#   python manage.py test tipr
+import json
+import logging
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.sessions import SessionMiddlewareStack
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from tipr import delta, lobby, sim
+from tipr.models import Game
+
+
+class QuietTestCase(SimpleTestCase):
+    def setUp(self):
+        # delta.reference_apply logs every delta it applies at warning level, on the root logger
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+
+class SimTests(SimpleTestCase):
+
+    # sim.py --stress: games played across threads come out as they do one at a time
+    def test_threads_match_serial(self):
+        for type in sim.rules_classes:
+            with self.subTest(type=type):
+                self.assertEqual(sim.stress(type, games=8, threads=4), [])
+
+    # a seeded rps game ends the same with fast_resolve as ticking through stage 4, less the
+    # timeline and messages it collects
+    def test_fast_resolve_matches_ticks(self):
+        def outcome(result):
+            gamestate = sim.normalise(result.gamestate)
+            gamestate['meta'].pop('timeline', None)
+            gamestate['meta'].pop('message', None)
+            return result.winner, result.rounds, result.error, gamestate
+
+        for options in ({}, {'timed': True}):
+            for seed in range(6):
+                with self.subTest(seed=seed, **options):
+                    ticked = sim.Simulation('rps', options=options, seed=seed).run()
+                    fast = sim.Simulation('rps', options={**options, 'fast_resolve': True}, seed=seed).run()
+                    self.assertEqual(outcome(fast), outcome(ticked))
+
+
+class DeltaTests(QuietTestCase):
+
+    # python -m tipr.delta: apply() does what reference_apply() did, to every delta of a few games
+    # and to their histories as the database has them
+    def test_apply_matches_reference(self):
+        for type, seeds in (('rps', (0, 1, 9)), ('liar', (0, 1))):
+            for options in ({}, {'timed': True}):
+                for seed in seeds:
+                    with self.subTest(type=type, seed=seed, **options):
+                        pairs, history = delta.record(type, seed, options)
+                        self.assertEqual(delta.differences(pairs, [json.loads(json.dumps(history))]), [])
+
+
+class HistoryTests(TestCase):
+
+    # appending works out the next seq without loading the interval, counting events not
+    # written yet
+    def test_append_without_loading(self):
+        client = Client()
+        client.post('/register/', {'name': 'alice'})
+        id = client.post('/sit/', {'seat': 0, 'type': 'rps'}).json()['game']
+        game = Game.objects.get(pk=id)
+        game.event('time', {})
+        with game.deferred():
+            game.event('time', {})
+            game.event('time', {})
+        self.assertNotIn(game.interval, game.history.intervals)
+        self.assertEqual(list(game.events.filter(interval=game.interval).values_list('seq', flat=True)),
+                         [0, 1, 2, 3])
+        self.assertEqual(len(Game.objects.get(pk=id).history[-1]), 4)
+
+
+class LobbyTests(TestCase):
+
+    # a version counter evicted before a change goes out is started again, not an error
+    def test_publish_after_eviction(self):
+        lobby.version()
+        real_incr = cache.incr
+
+        def evicted(key, *args, **kwargs):
+            cache.delete(key)
+            incr.side_effect = real_incr
+            return real_incr(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'incr', side_effect=evicted) as incr, \
+                self.captureOnCommitCallbacks(execute=True):
+            lobby.publish('changed', lobby.row(1, 'rps', 1, [['alice', ''], [True, False]]))
+        self.assertEqual(cache.get(lobby.change_key(lobby.version()))['id'], 1)
+
+
+class ConsumerTests(TransactionTestCase):
+
+    # the default session engine reads the session from the database, which connect mustn't do
+    # in the event loop
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_connect_with_database_sessions(self):
+        from tipr.websocket_urls import websocket_urlpatterns
+        client = Client()
+        client.post('/register/', {'name': 'alice'})
+        game = client.post('/sit/', {'seat': 0, 'type': 'rps'}).json()['game']
+        session = client.cookies['sessionid'].value
+
+        async def connect():
+            communicator = WebsocketCommunicator(SessionMiddlewareStack(URLRouter(websocket_urlpatterns)),
+                                                 f'/ws/game/{game}/', headers=[(b'cookie', f'sessionid={session}'.encode())])
+            connected, _ = await communicator.connect()
+            board = await communicator.receive_json_from(timeout=10)
+            await communicator.disconnect()
+            return connected, board
+
+        connected, board = async_to_sync(connect)()
+        self.assertTrue(connected)
+        self.assertIn('gameboard', board)
@@ -0,0 +1,158 @@
+# per-request traces: timed spans (load, rules, render, save) and events, sent to a sink when the
+# request finishes. off unless a sink or listener is configured, and then span() and event() outside
+# a trace, or with tracing off, cost a context variable lookup.
+#
+#   with tracing.trace('update', game=id):
+#       with tracing.span('load'):
+#           game = ...
+#       tracing.event('tick', delta=lambda: delta)
+#
+# payloads are only kept with payloads=True. callables in them are called then and not before, so
+# an expensive value (a gamestate, a delta) should be passed as a lambda.
+#
+# in Django settings:
+#   TIPR_TRACE = 'ring' | 'jsonl:<path>'   (default None: off)
+#   TIPR_TRACE_PAYLOADS = False
+#   TIPR_TRACE_RING_SIZE = 1000
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import threading
+import time
+
+sink = None
+payloads = False
+listeners = []  # also given every finished trace, see metrics.py
+
+current = contextvars.ContextVar('tipr_trace', default=None)
+ids = itertools.count(1)
+
+
+# the most recent traces, in memory
+class RingBuffer(object):
+    def __init__(self, size=1000):
+        self.traces = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.traces.append(record)
+
+    def records(self):
+        return list(self.traces)
+
+# one JSON line per trace, appended
+class JsonlFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=repr)
+        with self.lock, open(self.path, 'a') as out:
+            out.write(line + '\n')
+
+
+def configure(new_sink=None, capture_payloads=False):
+    global sink, payloads
+    sink = new_sink
+    payloads = capture_payloads
+
+# the sink described by TIPR_TRACE and friends
+def configure_from_settings():
+    from django.conf import settings
+    spec = getattr(settings, 'TIPR_TRACE', None)
+    if not spec:
+        new_sink = None
+    elif spec == 'ring':
+        new_sink = RingBuffer(getattr(settings, 'TIPR_TRACE_RING_SIZE', 1000))
+    elif spec.startswith('jsonl:'):
+        new_sink = JsonlFile(spec[len('jsonl:'):])
+    else:
+        raise ValueError(f"TIPR_TRACE should be 'ring' or 'jsonl:<path>', not {spec!r}")
+    configure(new_sink, getattr(settings, 'TIPR_TRACE_PAYLOADS', False))
+
+# payload values as they are now, as JSON, so later changes to a gamestate don't show up in its trace
+def capture(payload):
+    if not payloads or not payload:
+        return None
+    return json.loads(json.dumps({key: value() if callable(value) else value for key, value in payload.items()},
+                                 default=jsonable))
+
+# tracked state (see tracked.py) as its value, anything else JSON can't take as its repr
+def jsonable(value):
+    if callable(getattr(type(value), 'value', None)):
+        return value.value()
+    return repr(value)
+
+
+class Trace(object):
+    def __init__(self, name, payload):
+        self.record = {'id': next(ids), 'name': name, 'start': time.time(), 'ms': None,
+                       'payload': capture(payload), 'spans': [], 'events': [], 'counts': {}}
+        self.started = time.perf_counter()
+        self.open = []  # names of the spans we're inside
+
+    def offset(self):
+        return round((time.perf_counter() - self.started) * 1000, 3)
+
+@contextlib.contextmanager
+def trace(name, **payload):
+    if (sink is None and not listeners) or current.get() is not None:
+        # nested requests (a tick inside an update) are spans of the outer one
+        with span(name, **payload):
+            yield
+        return
+    active = Trace(name, payload)
+    token = current.set(active)
+    try:
+        yield
+    except Exception as e:
+        active.record['error'] = repr(e)
+        raise
+    finally:
+        current.reset(token)
+        active.record['ms'] = active.offset()
+        if sink is not None:
+            sink.emit(active.record)
+        for listener in listeners:
+            listener(active.record)
+
+class Span(object):
+    __slots__ = ('trace', 'name', 'entry', 'started')
+
+    def __init__(self, trace, name, payload):
+        self.trace = trace
+        self.name = name
+        self.entry = {'name': '.'.join(trace.open + [name]), 'at': trace.offset(), 'ms': None,
+                      'payload': capture(payload)}
+
+    def __enter__(self):
+        self.trace.open.append(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.entry['ms'] = round((time.perf_counter() - self.started) * 1000, 3)
+        self.trace.open.pop()
+        self.trace.record['spans'].append(self.entry)
+
+noop = contextlib.nullcontext()
+
+def span(name, **payload):
+    if (active := current.get()) is None:
+        return noop
+    return Span(active, name, payload)
+
+def event(name, **payload):
+    if (active := current.get()) is None:
+        return
+    active.record['events'].append({'name': name, 'at': active.offset(), 'span': '.'.join(active.open),
+                                    'payload': capture(payload)})
+
+# add to a running total on the trace, e.g. database queries
+def add(name, amount=1):
+    if (active := current.get()) is None:
+        return
+    counts = active.record['counts']
+    counts[name] = counts.get(name, 0) + amount
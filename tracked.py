@@ -0,0 +1,257 @@
+# copy-on-write view of a gamestate that remembers what changed, so the delta for utils.update
+# comes straight from the changes instead of a deepcopy of the state and a gen_patch over all of it.
+#
+#   gamestate = track(game.gamestate)
+#   gamestate.meta.round += 1
+#   gamestate.statements.append({'text': ..})
+#   gamestate.delta()  # {'meta': {'round': 4}, 'statements': {'ins': [{'text': ..}]}}
+#
+# the wrapped state is never modified. reads are Box-style (attributes, ga), and containers come
+# back wrapped so changes to them are tracked too. values assigned in are copied.
+import copy
+
+
+def track(state):
+    if isinstance(state, dict):
+        return TrackedDict(state)
+    if isinstance(state, list):
+        return TrackedList(state)
+    return state
+
+# a plain copy of anything, tracked or not
+def plain(value):
+    if isinstance(value, (TrackedDict, TrackedList)):
+        return value.value()
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+MISSING = object()
+
+
+class TrackedDict(object):
+    __slots__ = ('_base', '_set', '_deleted', '_children')
+
+    def __init__(self, base):
+        object.__setattr__(self, '_base', base)
+        object.__setattr__(self, '_set', {})  # key -> plain value assigned here
+        object.__setattr__(self, '_deleted', set())
+        object.__setattr__(self, '_children', {})  # key -> tracked container handed out by a read
+
+    def _current(self, key, default=MISSING):
+        if key in self._set:
+            return self._set[key]
+        if key in self._deleted:
+            return default
+        return self._base.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self._children:
+            return self._children[key]
+        value = self._current(key)
+        if value is MISSING:
+            raise KeyError(key)
+        if isinstance(value, (dict, list)):
+            value = self._children[key] = track(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._set[key] = plain(value)
+        self._deleted.discard(key)
+        self._children.pop(key, None)
+
+    def __delitem__(self, key):
+        if self._current(key) is MISSING:
+            raise KeyError(key)
+        self._set.pop(key, None)
+        self._children.pop(key, None)
+        self._deleted.add(key)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+    # Box.ga: the value at name, starting it as {} if it's missing
+    def ga(self, name):
+        if self._current(name) is MISSING:
+            self[name] = {}
+        return self[name]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self._base if key not in self._deleted and key not in self._set] + list(self._set)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return self._current(key) is not MISSING
+
+    def __eq__(self, other):
+        return self.value() == plain(other)
+
+    def __repr__(self):
+        return f'track({self.value()!r})'
+
+    def value(self):
+        return {key: self._children[key].value() if key in self._children else plain(self._current(key))
+                for key in self.keys()}
+
+    # the changes as a delta for utils.update. {} if nothing changed
+    def delta(self):
+        delta = {}
+        for key in self._deleted:
+            if key in self._base:
+                delta[key] = 'del'
+        for key, value in self._set.items():
+            if key in self._children:
+                value = self._children[key].value()
+            # update() merges dicts into what's there, so an assigned dict has to say so
+            delta[key] = {'replace': value} if isinstance(value, dict) else value
+        for key, child in self._children.items():
+            if key not in self._set and (child_delta := child.delta()) not in ({}, None):
+                delta[key] = child_delta
+        return delta
+
+
+class TrackedList(object):
+    __slots__ = ('_base', '_items', '_children', '_replaced')
+
+    def __init__(self, base):
+        self._base = base
+        self._items = list(base)  # shallow, containers in it stay shared until a read wraps them
+        self._children = {}  # index -> tracked container
+        self._replaced = False  # anything but appends and changes inside items: the delta is the whole list
+
+    def _index(self, idx):
+        if idx < 0:
+            idx += len(self._items)
+        if not 0 <= idx < len(self._items):
+            raise IndexError(idx)
+        return idx
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.value()[idx]
+        idx = self._index(idx)
+        if idx in self._children:
+            return self._children[idx]
+        value = self._items[idx]
+        if isinstance(value, (dict, list)):
+            value = self._children[idx] = track(value)
+        return value
+
+    def __setitem__(self, idx, value):
+        self._replace()
+        self._items[idx] = plain(value)
+
+    def __delitem__(self, idx):
+        self._replace()
+        del self._items[idx]
+
+    # fold tracked items back in, for changes that move indices around
+    def _replace(self):
+        if not self._replaced:
+            self._items = self.value()
+            self._children = {}
+            self._replaced = True
+
+    def append(self, value):
+        self._items.append(plain(value))
+
+    def extend(self, values):
+        self._items.extend(plain(value) for value in values)
+
+    def insert(self, idx, value):
+        self._replace()
+        self._items.insert(idx, plain(value))
+
+    def pop(self, idx=-1):
+        self._replace()
+        return self._items.pop(idx)
+
+    def remove(self, value):
+        self._replace()
+        self._items.remove(plain(value))
+
+    def clear(self):
+        self._replace()
+        self._items.clear()
+
+    def sort(self, *args, **kwargs):
+        self._replace()
+        self._items.sort(*args, **kwargs)
+
+    def reverse(self):
+        self._replace()
+        self._items.reverse()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self._items)))
+
+    def __contains__(self, value):
+        return any(item == value for item in self)
+
+    def __eq__(self, other):
+        return self.value() == plain(other)
+
+    def __repr__(self):
+        return f'track({self.value()!r})'
+
+    def index(self, value):
+        return self.value().index(plain(value))
+
+    def count(self, value):
+        return self.value().count(plain(value))
+
+    def value(self):
+        return [self._children[i].value() if i in self._children else plain(item)
+                for i, item in enumerate(self._items)]
+
+    # {'ins': [appended]} and {'upd': {index: delta}} for changes inside existing items, or the
+    # whole list if it was otherwise rearranged. update() can't apply list deltas to a list
+    # inside a list, so those replace the outer list too.
+    def delta(self):
+        if self._replaced:
+            return self.value()
+        base_len = len(self._base)
+        delta = {}
+        if len(self._items) > base_len:
+            delta['ins'] = [self._children[i].value() if i in self._children else plain(self._items[i])
+                            for i in range(base_len, len(self._items))]
+        changed = {}
+        for i, child in self._children.items():
+            if i < base_len and (child_delta := child.delta()) not in ({}, None):
+                if isinstance(child, TrackedList):
+                    return self.value()
+                changed[i] = child_delta
+        if changed:
+            delta['upd'] = changed
+        return delta
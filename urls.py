@@ -13,21 +13,39 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path, re_path
 
 from tipr.views import *
 
 
+# the paths clients poll and play through. under ASGI, TIPR_ASYNC_VIEWS = True serves them with the
+# async views; both sets are also always at sync/ and async/, to compare them (see pollbench.py)
+def play_paths(sit, submit, update, lobby, names=True):
+    named = lambda name: {'name': name} if names else {}
+    return [
+        path('sit/', sit.as_view(), **named('sit')),
+        path('submit/', submit.as_view(), **named('submit')),
+        path('update/<int:id>/', update.as_view(), **named('update')),
+        path('lobby/', lobby.as_view(), **named('lobby')),
+    ]
+
+sync_paths = play_paths(Sit, Submit, UpdateView, LobbyView, names=False)
+async_paths = play_paths(AsyncSit, AsyncSubmit, AsyncUpdateView, AsyncLobbyView, names=False)
+
 urlpatterns = [ 
     path('planetrip/', include('planetrip.urls')),
     path('goop/', include('goop.urls')),        
     path('admin/', admin.site.urls),
     path('', Home.as_view(), name='home'),
     path('register/', Register.as_view(), name='register'),
-    path('sit/', Sit.as_view(), name='sit'),
-    path('submit/', Submit.as_view(), name='submit'),
+    *(play_paths(AsyncSit, AsyncSubmit, AsyncUpdateView, AsyncLobbyView) if getattr(settings, 'TIPR_ASYNC_VIEWS', False)
+      else play_paths(Sit, Submit, UpdateView, LobbyView)),
+    path('sync/', include(sync_paths)),
+    path('async/', include(async_paths)),
     path('update_worker.js', Worker.as_view(), name='worker'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     re_path('game/(?P<id>\d+)', GamePage.as_view(), name='game'),
 ]
 
@@ -1,7 +1,10 @@
-import collections, sys
+import collections, copy, sys
+import hashlib
 import itertools
+import json
 import logging
 import pdb
+import random
 from datetime import datetime, timezone
 from itertools import chain
 import traceback
@@ -18,7 +21,7 @@ def b(e):
 
 
 CREATED = 0
-ACTIVE = 1  # one at a time, others are paused
+ACTIVE = 1  # others with the same players are paused, see views.pause_others
 PAUSED = 2
 FINISHED = 3
 
@@ -45,100 +48,50 @@ def opp(p):
         return seats[p=='p1']
     return seats[not p]
 
-import collections.abc
-
-
-# apply all ops to the base modifier, then apply the final modifier
-# e.g. starting hp 15, -2 base dmg, -1, x2 = -6 -> 9hp
-mod_table = {
-    'add': lambda x, y: x + y,
-    'mul': lambda x, y: x * y,
-}
-def combine_numeric_modifiers(mods):
-    final_mod = 0
-    for mod in mods:
-        final_mod = mod_table[mod[0]](final_mod, mod[1])
-    return final_mod
-
-# handling numbers:
-# update = False, ie, we're working on a delta
-# existing, new:
-#   nothing, number or tuple -> new value
-#   number, number -> new number
-#   number, tuple -> error. the idea is that numbers are for meta stuff and tuples are for gamestate vals
-#   tuple, number -> error
-#   (str, num), tuple -> (old tuple, new tuple)
-#   (tup, tup), tuple -> (tup, tup, new tuple)
-# update = True
-#   nothing, number -> number
-#   nothing, tuple -> tupleops(0). maybe. the idea is that this could handle "counters" in the future
-#   number, number -> new number
-#   number, tuple -> tupleops(number)
-def update(d, u):
-    logging.warning(f'{d}\n{u}')
-    if not u:
-        return d
-    for k, v in u.items():
-        if v == 'del':
-            del d[k]
-        elif v is None:
-            d[k] = None
-        elif k == 'dins':  # 'delta insert'
-            if 'ins' in d:
-                d['ins'].append(v)
-            else:
-                d['ins'] = [v]
-        elif type(v) is tuple:
-            if k not in d:
-                d[k] = v
-            else:
-                if type(d[k]) is tuple:
-                    d[k] = tuple(list(d[k]) + list(v))
-                elif type(d[k]) is int:
-                    base = d[k] if k in d else 0
-                    d[k] = base + combine_numeric_modifiers(v)
-                else:
-                    raise RuntimeError(f"Don't put tuples ({v}) on {d[k]}")
-        elif k in d and type(d[k]) is tuple:
-            raise RuntimeError(f"Don't put {v} on tuples ({d[k]})")
-        elif k in d and isinstance(d[k], list):
-            if isinstance(v, list):
-                d[k] = v
-                continue
-            if 'deletes' in v:
-                d[k] = filter(lambda i, x: i not in v['deletes'], enumerate(d[k]))
-            if 'del_values' in v:
-                for del_val in v['del_values']:
-                    d[k].remove(del_val)
-            if 'ins' in v:
-                d[k].extend(v['ins'])
-            if 'set' in v:
-                d[k][v['set'][0]] = v['set'][1]
-            if 'rep' in v:
-                d[k] = v['rep']
-            if 'upd' in v:
-                logging.warn(f'{d} v: {v}')
-                for idx, delta in v['upd'].items():
-                    d[k][idx] = update(d[k][idx], delta)
-        elif isinstance(v, collections.abc.Mapping):
-            if 'replace' in v:
-                d[k] = v['replace']
-            else:
-                d[k] = update(d.get(k, {}), v)
-        else:
-            try:
-                d[k] = v
-            except Exception as e:
-                logging.warning(f"Update error: {e}, {d}, {k}, {v}")
-                #s()
-    return d
+# deltas: see delta.apply
+from tipr.delta import apply as update, combine_numeric_modifiers, copy_state, mod_table, stored_delta
+
+# reinflate history at a non-keyframe point in time
+# history: [ [<keyframe>, <event>, ..], ..], or a models.History backed by the event table
+# interval_idx: keyframe to start from, as an index into the blessed history
+# count: number of states forward from keyframe to include. 0 = all for this keyframe.
+# last_only: just the specified state if True, all starting at keyframe if False
+def intermediate_states(history, interval_idx, count=0, last_only=False):
+    if hasattr(history, 'intermediate_states'):
+        return history.intermediate_states(interval_idx, count, last_only)
+    try:
+        # rewinds are part of linear history, but not part of blessed history. exclude them.
+        interval = list(filter(lambda interval: 'rewound' not in interval[0], history))[interval_idx]
+    except IndexError:
+        return None
+    frame = copy_state(interval[0])
+    if not last_only:
+        ret = [copy_state(frame)]
+    if count == 0:
+        count = len(interval)
+    for i in range(1, count):
+        frame = update(frame, stored_delta(interval[i]))
+        if not last_only:
+            ret.append(copy_state(frame))
+    if not last_only:
+        return ret
+    return Box(frame)
+
+# a game's randomness: a generator seeded from options.seed and the state it's about to change,
+# so the same state always rolls the same way and a game can be rebuilt from its seed and moves.
+# games from before seeds share the module-level generator.
+def game_rng(options, gamestate=None, salt=''):
+    seed = options.get('seed')
+    if seed is None:
+        return random
+    digest = hashlib.sha1(json.dumps(gamestate, sort_keys=True).encode()).hexdigest() if gamestate is not None else ''
+    return random.Random(f'{seed}:{salt}:{digest}')
 
 class NoChange(object):
     pass
 
 # WARNING: THIS IS CURRENTLY FOR LIAR ONLY
 def gen_patch(state1, state2, rec=False):
-    logging.warning(f"gen {state1} {state2}")
     # this can only happen on a recursive call, so the type is ok
 
     if rec:
@@ -146,14 +99,12 @@ def gen_patch(state1, state2, rec=False):
             return NoChange
         elif type(state1) != type(state2) and not (isinstance(state1, oBox) and isinstance(state2, oBox)):
             if isinstance(state2, dict):
-                logging.warning("REP: " + str(type(state1)) + " " + str(type(state2)) + " " + repr(state1) + "\nTO: " + repr(state2))
                 return {'replace': state2}
             return state2
     
     ret = {}
 
     if type(state1) in [str, int]:
-        logging.warning("BAR" + repr(ret))
         return state2
     
     if isinstance(state1, list):
@@ -167,11 +118,9 @@ def gen_patch(state1, state2, rec=False):
             ret['ins'] = state2[len(state1):]
         else:
             ret['rep'] = state2
-        logging.warning("OO" + repr(ret))            
         return ret
     
     if not state1:
-        logging.warning(f"N? {state1} {state2}")
         return state2
 
     for key in state1.keys() | state2.keys():
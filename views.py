@@ -1,18 +1,25 @@
 import json
 import logging
+import secrets
 from datetime import datetime, timedelta, timezone
-from termcolor import colored as c
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.cache import cache
 from django.db import transaction
+from django.db.models import F
 
 from tipr.utils import *
-from django.http.response import JsonResponse, HttpResponse
+from django.http.response import JsonResponse, HttpResponse, HttpResponseNotModified
 from django.shortcuts import render, redirect
 from django.template.loader import render_to_string
 from django.views import View
 
-from tipr.models import Game
+from tipr import lobby, metrics, tracing
+from tipr.hotstore import hot_store
+from tipr.models import Game, GamePlayer
+from tipr.render_cache import RenderCache, render_cache
+from tipr.scheduler import announce, ticker
 from tipr.rps import RPSRules
 from tipr.liar import LiarRules
 
@@ -22,19 +29,71 @@ rules_classes = {
 }
 reserved_names = ['']
 
-
+# session key -> name, for async views, so most polls don't wait on the session table. a new
+# name (Register) shows up in other processes within the ttl.
+session_names = RenderCache(size=10000, ttl=5)
+
+tracing.configure_from_settings()
+metrics.install()
+
+
+# which other games to pause when one starts or is looked at, TIPR_PAUSE_POLICY in settings:
+#   'shared' (default): active games with one of its players in them
+#   'all': every other active game, one game at a time on the server
+#   'none': leave them all running
+PAUSE_POLICIES = ('shared', 'all', 'none')
+
+# ids of the games to pause
+def games_to_pause(game):
+    policy = getattr(settings, 'TIPR_PAUSE_POLICY', 'shared')
+    if policy not in PAUSE_POLICIES:
+        raise ValueError(f'TIPR_PAUSE_POLICY should be one of {PAUSE_POLICIES}, not {policy!r}')
+    if policy == 'none':
+        return []
+    if policy == 'shared':
+        ids = Game.active_with([name for name in game.people[0] if name])
+    else:
+        ids = Game.objects.filter(status=ACTIVE).values_list('pk', flat=True)
+    return [id for id in ids if id != game.pk]
+
+# make game the active one, if it isn't already. one that's already running is left alone, so
+# looking at it doesn't write it, and move its version on for everyone watching, every time
 def pause_others(game):
-    if game.status == FINISHED:
+    if game.status in (FINISHED, ACTIVE):
         return
     if not all(game.people[1]):
         return
     game.status = ACTIVE
+    game.due = tznow().timestamp()
     game.save()
-    for g in (Game.objects.filter(status=ACTIVE) | \
-             Game.objects.filter(people__0__contains=game.people[0][0]) | \
-             Game.objects.filter(people__0__contains=game.people[0][1])).exclude(id=game.pk):
-        g.status = PAUSED
-        g.save()
+    ticker.poke(game.pk)
+    announce(game.pk)
+    paused = games_to_pause(game)
+    hot_store.release(paused)
+    Game.objects.filter(pk__in=paused).update(status=PAUSED, version=F('version') + 1)
+    hot_store.evict(paused)
+    GamePlayer.objects.filter(game__in=paused).update(status=PAUSED)
+    for values in Game.objects.filter(pk__in=paused).values_list('pk', 'type', 'status', 'people'):
+        lobby.publish('changed', lobby.row(*values))
+    for id in paused:
+        announce(id)
+
+CONFLICT_RETRIES = 5
+
+# step(game) on the game, checked out in a transaction. if another request wrote the game first
+# (Game.Conflict, see Game.write_row), the transaction is rolled back, the hot copy is dropped, and
+# step runs again on a fresh read, so it should only change the game and the database. announce
+# and ticker.poke wait for the commit, so they're fine in it. the checkout is the outer block so
+# the game stays locked until the commit: nobody sees state that might still roll back.
+def on_game(id, step):
+    for attempt in range(CONFLICT_RETRIES):
+        try:
+            with hot_store.checkout(id) as game, transaction.atomic():
+                return step(game)
+        except Game.Conflict:
+            metrics.inc('tipr_conflicts_total')
+            tracing.event('conflict', attempt=attempt)
+    raise Game.Conflict(f'game {id} kept changing')
 
 class Register(View):
     def post(self, request):
@@ -43,6 +102,8 @@ class Register(View):
             return JsonResponse({'error': 'please choose a different name'})
         cache.set(request.session.session_key, name)
         request.session['name'] = name
+        if request.session.session_key:
+            session_names.set(('session_name', request.session.session_key), name)
 
         next = request.session.get('redirected_from')
         if next:
@@ -51,6 +112,10 @@ class Register(View):
 
 class Sit(View):
     def post(self, request):
+        with tracing.trace('sit', game=request.POST.get('game')):
+            return self.traced(request)
+
+    def traced(self, request):
         name = request.session.get('name')
         if not name:
             return JsonResponse({'error': 'please register a name first'})
@@ -60,25 +125,42 @@ class Sit(View):
             game_type = request.POST.get('type')
             rules = rules_classes[game_type]
             options = update(rules.DEFAULT_OPTIONS.copy(), request.POST.get('options'))
-            options['deck'] = RPSRules.deck()
+            options['seed'] = secrets.randbits(48)
+            options['deck'] = RPSRules.deck(game_rng(options, salt='deck'))
             starting_seats = [['']*options['player_count'], [False]*options['player_count']]
-            starting_seats[0][seat] = name
-            starting_seats[1][seat] = True
-            game = Game(type=game_type, people=starting_seats, options=options, gamestate=rules.start_state(options))
-            game.keyframe()
+            with tracing.span('rules'):
+                game = Game(type=game_type, people=starting_seats, options=options, gamestate=rules.start_state(options))
+            with game.deferred():
+                game.sit(name, seat)
+                game.keyframe()
         else:
-            game = Game.objects.get(pk=gameid)
-            if game.people[0][seat]:
+            def join(game):
+                if not game:
+                    raise Game.DoesNotExist
+                if game.people[0][seat]:
+                    return None
+                with game.deferred():
+                    game.sit(name, seat)
+                    pause_others(game)
+                return game
+            try:
+                game = on_game(gameid, join)
+            except Game.Conflict:
+                return JsonResponse({'error': 'the game is busy, please try again'})
+            if not game:
                 return JsonResponse({'error': 'seat already taken'})
-            game.people[0][seat] = name
-            game.people[1][seat] = True
-            if all(game.people[1]):
-                game.status = ACTIVE
-                pause_others(game)
-        game.save()
         request.session['gameid'] = game.pk
         return JsonResponse({'game': game.pk})  # unused, revisit
 
+async def session_name(request):
+    key = request.session.session_key
+    name = session_names.get(('session_name', key)) if key else None
+    if name is None:
+        name = await sync_to_async(request.session.get)('name', '')
+        if key:
+            session_names.set(('session_name', key), name)
+    return name or None
+
 def get_seat(game, name):
     seat = -1
     if name and name in game.people[0][:2]:
@@ -87,116 +169,272 @@ def get_seat(game, name):
 
 class Update(object):
 
+    # version: the last version this client rendered. if nothing has changed since,
+    # all that's needed is the timer, which comes straight from the row.
+    # chat_cursor: the last chat message this client has, see Rules.render_gameboard
     @staticmethod
-    def do(name, id, load):
+    def do(name, id, load, version=None, chat_cursor=None):
+        with tracing.trace('update', game=id, load=load, version=version):
+            return Update.traced(name, id, load, version, chat_cursor)
 
-        with transaction.atomic():
+    # the same, for async views. an unchanged poll is answered in the event loop, from the hot store
+    # or with one async query; anything else needs the rules, locks and a transaction, in a thread.
+    @staticmethod
+    async def ado(name, id, load, version=None, chat_cursor=None):
+        with tracing.trace('update', game=id, load=load, version=version):
             now = tznow()
+            if version is not None:
+                with tracing.span('unchanged'):
+                    unchanged = Update.unchanged_response(await Update.aunchanged_row(id), version, now)
+                if unchanged:
+                    return unchanged
+            return await sync_to_async(Update.changed)(name, id, load, chat_cursor, now)
 
-            if id:
-                game = Game.objects.filter(pk=id)
-            else:
-                game = None
+    @staticmethod
+    def traced(name, id, load, version, chat_cursor):
+        now = tznow()
+        if version is not None:
+            with tracing.span('unchanged'):
+                unchanged = Update.unchanged_response(Update.unchanged_row(id), version, now)
+            if unchanged:
+                return unchanged
+        return Update.changed(name, id, load, chat_cursor, now)
+
+    @staticmethod
+    def changed(name, id, load, chat_cursor, now):
+        def step(game):
             if not game:
                 return {'error': 'This game does not exist'}
-            game = game.get()
-            if game.status == CREATED:
-                pass
-                #return {'error': 'waiting for all players to be ready'}
-            gamestate = Box(game.gamestate)
+            with game.deferred():
+                if game.status == CREATED:
+                    pass
+                    #return {'error': 'waiting for all players to be ready'}
+                rules = rules_classes[game.type]
+                seat = get_seat(game, name)
+
+                # with the scheduler running, ticks happen there and polling only reads
+                if seat != -1 and game.status == ACTIVE and not ticker.running():
+                    with tracing.span('rules'):
+                        Update.advance(game, rules, now)
+            # after the flush, so the render is cached under the version it shows
+            with tracing.span('render'):
+                response = rules.render_gameboard(name, load, seat, game, Box(game.gamestate), now, chat_cursor)
+            response.version = game.version
+            return response
+        try:
+            return on_game(id, step)
+        except Game.Conflict:
+            return {'error': 'the game is busy, please try again'}
 
-            rules = rules_classes[game.type]
-            seat = get_seat(game, name)
+    # what unchanged_response needs from the row
+    UNCHANGED_FIELDS = ('version', 'status', 'last_tick', 'next_tick', 'due')
 
-            if seat == -1 or game.status != ACTIVE:
-                resp = rules.render_gameboard(name, load, seat, game, gamestate, now)
-                return resp
-
-            # account for start of game conditions
-            if game.next_tick is None:
-                game.next_tick = rules.next_tick(game)
-                game.save()
-            if game.last_tick is None:
-                game.last_tick = now
-                game.save()
-
-            ticked = False
-            if rules.should_update(game, gamestate, now):
-                logging.warning(2)
-                ticked = True
-                keyframe_name = rules.keyframe_name
-                prev = gamestate.meta[keyframe_name]
-                try:
-                    delta = rules.do_update(game)
-                    logging.warn(c(f'TICK: {delta}', "red"))
-                    update(gamestate, delta)
-                    logging.warn(f'TICK COMPLETE: {gamestate}')
-
-                    for message in gamestate.meta.message:
-                        game.chat('system', message, now)
-                    gamestate.meta.message = []
-                    game.gamestate = dict(gamestate)
-
-                    if gamestate.meta[keyframe_name] != prev:
-                        if winner := rules.winner(gamestate):
-                            game.chat('system', winner, now)
-                            game.status = FINISHED
-                        game.keyframe()
-                    else:
-                        game.event('time', delta, now)
-                except Exception as e:
-                    logging.exception(f'rewinding')
-                    s()
-                    message = f'error doing timed update: {e}\nresetting to {keyframe_name} {prev}'
-                    game.chat('system', message, now)
-                    game.rewind(1, message)
-                    return rules.render_gameboard(name, load, seat, game, gamestate, now)
-
-            gameboard = rules.render_gameboard(name, load, seat, game, gamestate, now)
-            if ticked:
-                game.last_tick = now
-                game.next_tick = rules.next_tick(game)
-                game.save()
-                game.refresh_from_db()
-            return gameboard
+    @staticmethod
+    def unchanged_row(id):
+        if game := hot_store.peek(id):
+            return tuple(getattr(game, field) for field in Update.UNCHANGED_FIELDS)
+        return Game.objects.filter(pk=id).values_list(*Update.UNCHANGED_FIELDS).first()
+
+    @staticmethod
+    async def aunchanged_row(id):
+        if game := hot_store.peek(id):
+            return tuple(getattr(game, field) for field in Update.UNCHANGED_FIELDS)
+        return await Game.objects.filter(pk=id).values_list(*Update.UNCHANGED_FIELDS).afirst()
+
+    @staticmethod
+    def unchanged_response(row, version, now):
+        if not row or row[0] != version:
+            return None
+        version, status, last_tick, next_tick, due = row
+        if status == ACTIVE and due is not None and due <= now.timestamp() and not ticker.running():
+            return None  # the rules have to run
+        duration, remaining = Game.timer(status, last_tick, next_tick, now)
+        return Box(unchanged=True, version=version, timer=f'{remaining} / {duration}')
+
+    # run the timed update if one is due. returns True if the game changed.
+    @staticmethod
+    def advance(game, rules, now):
+        gamestate = Box(game.gamestate)
+
+        # account for start of game conditions
+        if game.next_tick is None:
+            game.next_tick = rules.next_tick(game)
+            game.save()
+        if game.last_tick is None:
+            game.last_tick = now
+            game.save()
+
+        if not rules.should_update(game, gamestate, now):
+            game.due = rules.deadline(game, gamestate)
+            return False
+        keyframe_name = rules.keyframe_name
+        prev = gamestate.meta[keyframe_name]
+        try:
+            delta = rules.do_update(game)
+            metrics.inc('tipr_ticks_total', type=game.type)
+            tracing.event('tick', delta=lambda: delta)
+            update(gamestate, delta)
+
+            for message in gamestate.meta.message:
+                game.chat('system', message, now)
+            gamestate.meta.message = []
+            # plain JSON, as the database would give it back: a hot game (hotstore.py) keeps it
+            game.gamestate = json.loads(json.dumps(gamestate))
+
+            if gamestate.meta[keyframe_name] != prev:
+                if winner := rules.winner(gamestate):
+                    game.chat('system', winner, now)
+                    game.status = FINISHED
+                game.keyframe()
+            else:
+                game.event('time', delta, now)
+        except Exception as e:
+            logging.exception(f'rewinding')
+            message = f'error doing timed update: {e}\nresetting to {keyframe_name} {prev}'
+            game.chat('system', message, now)
+            game.rewind(1, message)
+            return True
+
+        game.last_tick = now
+        game.next_tick = rules.next_tick(game)
+        game.due = rules.deadline(game, Box(game.gamestate))
+        game.save()
+        return True
+
+    # scheduler entry point. returns (changed, next deadline)
+    @staticmethod
+    def advance_by_id(id):
+        def tick(game):
+            if not game or game.status != ACTIVE:
+                return False, None
+            rules = rules_classes[game.type]
+            with game.deferred():
+                with tracing.span('rules'):
+                    changed = Update.advance(game, rules, tznow())
+            return changed, rules.deadline(game, Box(game.gamestate))
+        with tracing.trace('tick', game=id):
+            return on_game(id, tick)
 
 class Submit(View):
     def post(self, request):
+        with tracing.trace('submit', game=request.POST.get('game')):
+            return self.traced(request)
+
+    def traced(self, request):
         now = tznow()
         name = request.session.get('name')
         try:
-            game = int(request.POST.get('game'))
-            game = Game.objects.filter(pk=game).get()
-        except:
-            return JsonResponse({'error': f'game {game.people}  does not exist'})
+            game_id = int(request.POST.get('game'))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': f'game {request.POST.get("game")} does not exist'})
         move = json.loads(request.POST.get('move'))
+        try:
+            response = on_game(game_id, lambda game: game and Submit.step(game, name, move, now))
+        except Game.Conflict:
+            return JsonResponse({'error': 'the game is busy, please try again'})
+        return response or JsonResponse({'error': f'game {game_id} does not exist'})
 
-        if isinstance(move, str) and move.startswith('chat: '):
-
-            move = move[6:]
-            if move == 'rewind':
-                msg = f'{name} clicked rewind'
-                game.rewind(1, msg)
+    # the move, or chat, on the checked out game, see on_game
+    @staticmethod
+    def step(game, name, move, now):
+        with game.deferred():
+            if isinstance(move, str) and move.startswith('chat: '):
+
+                move = move[6:]
+                if move == 'rewind':
+                    msg = f'{name} clicked rewind'
+                    game.rewind(1, msg)
+                    ticker.poke(game.pk)
+                    announce(game.pk)
+                    return JsonResponse({})
+                game.chat(name, move)
+                announce(game.pk)
                 return JsonResponse({})
-            game.chat(name, move)
-            return JsonResponse({})
                 
 
-        rules = rules_classes[game.type]
-        seat = get_seat(game, name)
-        if seat == -1:
-            return JsonResponse({'error': f'{name} tried to move but is not a player'})
-        # {"type": "selection", "selection": <slot>}
-        logging.warn(c(f'MOVE: {seat} {request.POST.get("move")}', "red"))
-        delta = rules.move(game, seat, move)
-        logging.warning(f"DELTA {delta} from {move}")
-        if 'error' in delta:
-            logging.warn(delta)
-            return JsonResponse(delta)
-        game.event('move', move, now)
-        update(game.gamestate, delta)
-        game.save()
-        return JsonResponse(game.response(rules.response(game, seat), now))
+            rules = rules_classes[game.type]
+            seat = get_seat(game, name)
+            if seat == -1:
+                return JsonResponse({'error': f'{name} tried to move but is not a player'})
+            # {"type": "selection", "selection": <slot>}
+            with tracing.span('rules'):
+                delta = rules.move(game, seat, move)
+            tracing.event('move', seat=seat, move=move, delta=lambda: delta)
+            if 'error' in delta:
+                return JsonResponse(delta)
+            game.event('move', {'seat': seat, 'move': move}, now)
+            update(game.gamestate, delta)
+            game.due = rules.deadline(game, Box(game.gamestate))
+            game.save()
+            ticker.poke(game.pk)
+            announce(game.pk)
+            with tracing.span('render'):
+                return JsonResponse(game.response(rules.response(game, seat), now))
+
+# a move changes the game under its lock and in a transaction, so the work stays in a thread; being
+# async only means a submit doesn't hold a thread while it waits for one
+class AsyncSubmit(Submit):
+    async def post(self, request):
+        with tracing.trace('submit', game=request.POST.get('game')):
+            return await sync_to_async(self.traced)(request)
+
+class AsyncSit(Sit):
+    async def post(self, request):
+        with tracing.trace('sit', game=request.POST.get('game')):
+            return await sync_to_async(self.traced)(request)
+
+
+# the update path over plain HTTP. the ETag carries the version, so an unchanged poll is a 304.
+class UpdateView(View):
+    def get(self, request, id):
+        name = request.session.get('name')
+        return self.respond(Update.do(name, id, *self.params(request, name)), name)
+
+    # (load, version, chat_cursor)
+    @staticmethod
+    def params(request, name):
+        version = request.GET.get('version')
+        etag = request.headers.get('If-None-Match', '').strip('"')
+        if etag.endswith(f'-{name}'):
+            version = etag[:-len(f'-{name}')]
+        version = UpdateView.untag(version) if version else None
+        chat_cursor = request.GET.get('chat_cursor')
+        chat_cursor = int(chat_cursor) if chat_cursor and chat_cursor.isdigit() else None
+        return request.GET.get('load') == 'true', version, chat_cursor
+
+    @staticmethod
+    def respond(response, name):
+        if 'version' in response:
+            response.version = UpdateView.tag(response.version)
+        if response.get('unchanged'):
+            resp = HttpResponseNotModified()
+        else:
+            resp = JsonResponse(response)
+        if 'version' in response:
+            resp['ETag'] = f'"{response["version"]}-{name}"'
+            resp['Cache-Control'] = 'no-cache'
+        return resp
+
+    # the version as clients get it. with the hot store on, versions of held ticks are lost in a
+    # crash and handed out again for other states, so they carry the process's epoch
+    # (hotstore.HotStore.epoch), and one from before a restart never matches
+    @staticmethod
+    def tag(version):
+        return f'{hot_store.epoch}.{version}' if hot_store.enabled() else version
+
+    @staticmethod
+    def untag(tag):
+        if hot_store.enabled():
+            epoch, _, tag = tag.rpartition('.')
+            if epoch != hot_store.epoch:
+                return None
+        return int(tag) if tag.isdigit() else None
+
+# the same, without a thread per poll, see Update.ado
+class AsyncUpdateView(View):
+    async def get(self, request, id):
+        name = await session_name(request)
+        return UpdateView.respond(await Update.ado(name, id, *UpdateView.params(request, name)), name)
 
 
 class Home(View):
@@ -206,37 +444,94 @@ class Home(View):
 
 class GamePage(View):
     def get(self, request, id):
-        game = Game.objects.get(pk=id)
-        pause_others(game)
+        def look(game):
+            if not game:
+                raise Game.DoesNotExist
+            pause_others(game)
+            return game
+        game = on_game(id, look)
         request.session['gameid'] = game.pk
         return render(request, f'{game.type}.html',
                       {'game': game, 'gametype': game.type, 'seat': get_seat(game, request.session.get('name')), **rules_classes[game.type].gameboard_data(game)})
 
 class GameList(object):
 
+    # version: the lobby version (see lobby.py) this client last rendered
+    @staticmethod
+    def do(name, load, version=None):
+        with tracing.trace('lobby', load=load, version=version):
+            return GameList.traced(name, load, version)
+
     @staticmethod
-    def do(name, load):
+    def traced(name, load, version):
         response = Box()
         response.name = name
-        gamelist_context = Box()
-        gamelist_context.name = name
-        gamelist_context.my_games = []
-        gamelist_context.other_games = []
-        for game in Game.objects.filter(status__lt=FINISHED):
-            if name and name in game.people[0]:
-                gamelist_context.my_games.append(game)
-
-            else:
-                gamelist_context.other_games.append(game)
-        response.gamelist = render_to_string('gamelist.html', gamelist_context)
-        if not load and response.gamelist == cache.get(f'{name}_gamelist'):
+        response.version = lobby.version()
+        if not load and str(version) == str(response.version):
             response.gamelist = 'U'
-        else:
-            cache.set(f'{name}_gamelist', response.gamelist)
+            return response
+
+        def render():
+            gamelist_context = Box()
+            gamelist_context.name = name
+            gamelist_context.my_games = list(Game.games_of(name).order_by('pk')) if name else []
+            gamelist_context.other_games = Game.objects.filter(status__lt=FINISHED).exclude(
+                pk__in=[game.pk for game in gamelist_context.my_games]).order_by('pk')
+            return render_to_string('gamelist.html', gamelist_context)
+        with tracing.span('render'):
+            response.gamelist = render_cache.get_or_render(('lobby', name, response.version), render)
 
         return response
 
  
+# JSON lobby pages and the change feed, see lobby.py
+class LobbyView(View):
+    def get(self, request):
+        with tracing.trace('lobby'):
+            name = request.session.get('name')
+            since = self.since(request)
+            if since is not None:
+                version, changes = lobby.changes_since(since)
+                if changes is not None:
+                    return JsonResponse({'version': version, 'changes': changes})
+            with tracing.span('load'):
+                response = lobby.page(name, *self.filters(request))
+            return JsonResponse(dict(response, reset=since is not None))
+
+    @staticmethod
+    def since(request):
+        since = request.GET.get('since')
+        return int(since) if since and since.isdigit() else None
+
+    # (type, open, mine, number, per_page) for lobby.page
+    @staticmethod
+    def filters(request):
+        number = request.GET.get('page', '')
+        number = int(number) if number.isdigit() and int(number) > 0 else 1
+        per_page = request.GET.get('per_page', '')
+        per_page = min(int(per_page), lobby.MAX_PER_PAGE) if per_page.isdigit() and int(per_page) > 0 else lobby.PER_PAGE
+        return request.GET.get('type') or None, request.GET.get('open') == '1', request.GET.get('mine') == '1', number, per_page
+
+class AsyncLobbyView(View):
+    async def get(self, request):
+        with tracing.trace('lobby'):
+            since = LobbyView.since(request)
+            if since is not None:
+                version, changes = await lobby.achanges_since(since)
+                if changes is not None:
+                    return JsonResponse({'version': version, 'changes': changes})
+            name = await session_name(request)
+            with tracing.span('load'):
+                response = await lobby.apage(name, *LobbyView.filters(request))
+            return JsonResponse(dict(response, reset=since is not None))
+
+
+# Prometheus text, see metrics.py
+class MetricsView(View):
+    def get(self, request):
+        return HttpResponse(metrics.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class Worker(View):
     def get(self, request):
         logging.warning('huh?')
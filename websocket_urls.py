@@ -0,0 +1,7 @@
+from django.urls import path
+
+from tipr.consumers import GameConsumer
+
+websocket_urlpatterns = [
+    path('ws/game/<int:id>/', GameConsumer.as_asgi()),
+]